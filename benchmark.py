@@ -0,0 +1,150 @@
+
+""" Micro-benchmarks for the Network kernels used by the Parallel Tempering samplers"""
+
+from __future__ import print_function, division
+import contextlib
+import io
+import os
+import shutil
+import tempfile
+import timeit
+import numpy as np
+from pt_bntl import Network, DeepNetwork, ParallelTemperingTL, BACKENDS, sparse_inputs, num_weights
+
+#Topologies from main() in pt_bntl.py, with row counts typical of one UJIndoorLoc building/floor and the Sarcos train set
+PROBLEMS = {'UJIndoorLoc': ([520, 140, 2], 1500), 'Sarcos': ([21, 55, 1], 44484)}
+
+def sigmoid_float128(x):
+	#Previous Network.sigmoid, kept as the reference the stable kernel is timed against
+	x = x.astype(np.longdouble)
+	return 1 / (1 + np.exp(-x))
+
+def time_call(fn, repeat=5, number=10):
+	return min(timeit.repeat(fn, repeat=repeat, number=number)) / number
+
+def bench_sigmoid():
+	print('{:<12} {:<10} {:>14} {:>14} {:>9} {:>12}'.format('problem', 'dtype', 'float128 (ms)', 'stable (ms)', 'speedup', 'max abs err'))
+	for name, (topology, rows) in PROBLEMS.items():
+		for dtype in (np.float64, np.float32):
+			#Hidden layer pre-activations dominate the per-call cost, so time the kernel on those
+			z1 = (np.random.randn(rows, topology[1]) * 4).astype(dtype)
+			reference = sigmoid_float128(z1)
+			with np.errstate(over='raise'):
+				result = Network.sigmoid(z1)
+			assert result.dtype == dtype
+			error = np.max(np.abs(result - reference))
+			old = time_call(lambda: sigmoid_float128(z1))
+			new = time_call(lambda: Network.sigmoid(z1))
+			print('{:<12} {:<10} {:>14.3f} {:>14.3f} {:>8.1f}x {:>12.2e}'.format(name, np.dtype(dtype).name, old*1000, new*1000, old/new, error))
+
+def wap_rows(rows, inputs, detected=0.04):
+	#UJIndoorLoc-like RSSI block: 100 means the WAP was not detected, detections fall in [-104, 0]
+	X = np.full((rows, inputs), 100.0)
+	mask = np.random.uniform(0, 1, X.shape) < detected
+	X[mask] = np.random.uniform(-104, 0, mask.sum())
+	return X
+
+def bench_sparse():
+	topology, rows = PROBLEMS['UJIndoorLoc']
+	print('{:<12} {:<10} {:>9} {:>14} {:>14} {:>9} {:>12}'.format('problem', 'dtype', 'density', 'dense (ms)', 'sparse (ms)', 'speedup', 'max abs err'))
+	for dtype in (np.float64, np.float32):
+		data = np.hstack([wap_rows(rows, topology[0]), np.random.uniform(0, 1, (rows, topology[2]))]).astype(dtype)
+		fnn = Network(topology, data, data, 0.1, dtype=dtype)
+		inputs = sparse_inputs(data, topology[0], 1.0)
+		w = fnn.encode().copy()
+		error = np.max(np.abs(fnn.evaluate_proposal(data, w) - fnn.evaluate_proposal(data, w, inputs=inputs)))
+		dense = time_call(lambda: fnn.evaluate_proposal(data, w))
+		csr = time_call(lambda: fnn.evaluate_proposal(data, w, inputs=inputs))
+		print('{:<12} {:<10} {:>9.3f} {:>14.3f} {:>14.3f} {:>8.1f}x {:>12.2e}'.format('UJIndoorLoc', np.dtype(dtype).name, inputs.density, dense*1000, csr*1000, dense/csr, error))
+
+def bench_depth(topologies=([520, 140, 2], [520, 64, 32, 2], [520, 32, 16, 8, 2])):
+	#Per-sample cost of the forward pass and gradient for the UJIndoorLoc net against deeper, narrower ones
+	rows = PROBLEMS['UJIndoorLoc'][1]
+	print('{:<22} {:>9} {:>14} {:>14}'.format('topology', 'weights', 'forward (ms)', 'gradient (ms)'))
+	for topology in topologies:
+		data = np.hstack([wap_rows(rows, topology[0]), np.random.uniform(0, 1, (rows, topology[-1]))])
+		inputs = sparse_inputs(data, topology[0], 0.3)
+		fnn = DeepNetwork(topology, data, data, 0.1)
+		w = fnn.encode().copy()
+		forward = time_call(lambda: fnn.evaluate_proposal(data, w, inputs=inputs))
+		gradient = time_call(lambda: fnn.evaluate_gradient(data, w, 0.01, 1.0, 25, inputs=inputs))
+		print('{:<22} {:>9} {:>14.3f} {:>14.3f}'.format(str(topology), num_weights(topology), forward*1000, gradient*1000))
+
+def bench_backends():
+	#Gaussian likelihood of one proposal through every backend that can be built here
+	print('{:<12} {:<10} {:>16} {:>12}'.format('problem', 'backend', 'likelihood (ms)', 'max abs err'))
+	for name, (topology, rows) in PROBLEMS.items():
+		data = np.random.uniform(0, 1, (rows, topology[0] + topology[2]))
+		fnn = Network(topology, data, data, 0.1)
+		w = fnn.encode().copy()
+		reference = BACKENDS['numpy']().gaussian_likelihood(fnn, data, w, 0.01)[0]
+		for backend_name, backend in sorted(BACKENDS.items()):
+			try:
+				backend = backend()
+			except ImportError:
+				print('{:<12} {:<10} {:>16}'.format(name, backend_name, 'not installed'))
+				continue
+			error = abs(backend.gaussian_likelihood(fnn, data, w, 0.01)[0] - reference)
+			elapsed = time_call(lambda: backend.gaussian_likelihood(fnn, data, w, 0.01))
+			print('{:<12} {:<10} {:>16.3f} {:>12.2e}'.format(name, backend_name, elapsed*1000, error))
+
+def synthetic_task(rows, topology):
+	#Same recipe as datasets/generate_synthetic_data.py, squashed into the (0, 1) range of the output layer
+	x = np.random.uniform(0, 1, (rows, topology[0]))
+	y = x.dot(np.random.randn(topology[0], topology[2]))
+	y = (y - y.min()) / (y.max() - y.min())
+	return np.hstack([x, y])
+
+def posterior_summary(precision, seed, topology=[4, 25, 1], samples=2000, num_chains=4):
+	#One fixed dataset for every run, the seed only drives the chains (through ParallelTemperingTL's SeedSequence)
+	np.random.seed(0)
+	train_data = [synthetic_task(400, topology)]
+	test_data = [synthetic_task(200, topology)]
+	target_train_data = synthetic_task(400, topology)
+	target_test_data = synthetic_task(200, topology)
+	directory = tempfile.mkdtemp()
+	cwd = os.getcwd()
+	try:
+		os.chdir(directory)
+		with contextlib.redirect_stdout(io.StringIO()):
+			pt = ParallelTemperingTL(num_chains, samples, 1, train_data, test_data, target_train_data, target_test_data, topology, directory + '/run', 20, 10, precision=precision, seed=seed)
+			pt.initialize_chains(0.2)
+			_, target_pos_w, _, _, target_rmse_train, target_rmse_test, _, _ = pt.run_chains()
+		#Summaries of the T=1 target chain, the one the posterior is reported from, taken while its file is still there
+		return {'rmse_train_mean': np.mean(target_rmse_train[0]), 'rmse_train_std': np.std(target_rmse_train[0]),
+				'rmse_test_mean': np.mean(target_rmse_test[0]), 'rmse_test_std': np.std(target_rmse_test[0]),
+				'w_mean_abs': np.mean(np.abs(np.mean(target_pos_w[0], axis=0))), 'w_std_mean': np.mean(np.std(target_pos_w[0], axis=0)),
+				'pos_w_bytes': sum(chain.nbytes for chain in target_pos_w)}
+	finally:
+		os.chdir(cwd)
+		shutil.rmtree(directory)
+
+def drift_report():
+	#Runs float64 twice with different seeds so the float32 drift can be read against plain Monte Carlo variation
+	reference = posterior_summary('float64', seed=1)
+	rerun = posterior_summary('float64', seed=2)
+	single = posterior_summary('float32', seed=1)
+	print('{:<16} {:>12} {:>12} {:>12} {:>14} {:>14}'.format('summary', 'float64', 'float32', 'rel. drift', 'float64 rerun', 'MC variation'))
+	for key in sorted(reference):
+		drift = abs(single[key] - reference[key]) / abs(reference[key])
+		noise = abs(rerun[key] - reference[key]) / abs(reference[key])
+		print('{:<16} {:>12.5g} {:>12.5g} {:>11.2%} {:>14.5g} {:>13.2%}'.format(key, reference[key], single[key], drift, rerun[key], noise))
+
+def main():
+	np.random.seed(1)
+	print('Network.sigmoid per-call time')
+	bench_sigmoid()
+	print('')
+	print('Network.evaluate_proposal, dense vs sparse first layer')
+	bench_sparse()
+	print('')
+	print('DeepNetwork cost per sample on UJIndoorLoc-like rows (sparse inputs)')
+	bench_depth()
+	print('')
+	print('Likelihood backends')
+	bench_backends()
+	print('')
+	print('Posterior summaries, float32 vs float64 (synthetic task)')
+	drift_report()
+
+if __name__ == "__main__": main()
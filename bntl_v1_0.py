@@ -33,7 +33,7 @@ def convert_time(secs):
 
 class Network(object):
 
-    def __init__(self, Topo, Train, Test, learn_rate = 0.5, alpha = 0.1):
+    def __init__(self, Topo, Train, Test, learn_rate = 0.5, alpha = 0.1, dtype = np.float64):
         self.Top = Topo  # NN topology [input, hidden, output]
         self.TrainData = Train
         self.TestData = Test
@@ -42,18 +42,30 @@ class Network(object):
         self.alpha = alpha
         self.NumSamples = self.TrainData.shape[0]
 
-        self.W1 = np.random.randn(self.Top[0], self.Top[1]) / np.sqrt(self.Top[0])
-        self.B1 = np.random.randn(1, self.Top[1]) / np.sqrt(self.Top[1])  # bias first layer
-        self.W2 = np.random.randn(self.Top[1], self.Top[2]) / np.sqrt(self.Top[1])
-        self.B2 = np.random.randn(1, self.Top[2]) / np.sqrt(self.Top[1])  # bias second layer
+        #One contiguous parameter buffer in the flat w layout [W1, W2, B1, B2]; the layer matrices are permanent views into it
+        w_layer1size = self.Top[0] * self.Top[1]
+        w_layer2size = self.Top[1] * self.Top[2]
+        b_start = w_layer1size + w_layer2size
+        self.w = np.zeros(b_start + self.Top[1] + self.Top[2], dtype=dtype)
+        self.W1 = self.w[0:w_layer1size].reshape(self.Top[0], self.Top[1])
+        self.W2 = self.w[w_layer1size:b_start].reshape(self.Top[1], self.Top[2])
+        self.B1 = self.w[b_start:b_start + self.Top[1]]  # bias first layer
+        self.B2 = self.w[b_start + self.Top[1]:]  # bias second layer
+
+        self.W1[:] = np.random.randn(self.Top[0], self.Top[1]) / np.sqrt(self.Top[0])
+        self.B1[:] = np.random.randn(self.Top[1]) / np.sqrt(self.Top[1])
+        self.W2[:] = np.random.randn(self.Top[1], self.Top[2]) / np.sqrt(self.Top[1])
+        self.B2[:] = np.random.randn(self.Top[2]) / np.sqrt(self.Top[1])
 
         self.hidout = np.zeros((1, self.Top[1]))  # output of first hidden layer
         self.out = np.zeros((1, self.Top[2]))  # output last layer
 
     @staticmethod
     def sigmoid(x):
-        x = x.astype(np.float128)
-        return 1 / (1 + np.exp(-x))
+        # stable logistic in the working dtype of x: exp only sees -|x|, so it never overflows
+        e = np.exp(-np.abs(x))
+        r = 1 / (1 + e)
+        return np.where(x >= 0, r, e * r)
 
     def sampleEr(self, actualout):
         error = np.subtract(self.out, actualout)
@@ -81,25 +93,13 @@ class Network(object):
         self.B1 += (-1 * self.lrate * hid_delta)
 
     def decode(self, w):
-        w_layer1size = self.Top[0] * self.Top[1]
-        w_layer2size = self.Top[1] * self.Top[2]
-
-        w_layer1 = w[0:w_layer1size]
-        self.W1 = np.reshape(w_layer1, (self.Top[0], self.Top[1]))
-
-        w_layer2 = w[w_layer1size:w_layer1size + w_layer2size]
-        self.W2 = np.reshape(w_layer2, (self.Top[1], self.Top[2]))
-
-
-        self.B1 = w[w_layer1size + w_layer2size :w_layer1size + w_layer2size + self.Top[1]]
-        self.B2 = w[w_layer1size + w_layer2size + self.Top[1] :w_layer1size + w_layer2size + self.Top[1] + self.Top[2]]
-
+        # copy w into the parameter buffer, the W1, W2, B1, B2 views pick it up without reslicing
+        if w is not self.w:
+            np.copyto(self.w, w)
 
     def encode(self):
-        w1 = self.W1.ravel()
-        w2 = self.W2.ravel()
-        w = np.concatenate([w1, w2, self.B1, self.B2])
-        return w
+        # the buffer itself, not a copy: callers that keep it across decode() calls must copy it
+        return self.w
 
     @staticmethod
     def scaler(data, maxout=1, minout=0, maxin=1, minin=0):
@@ -116,14 +116,19 @@ class Network(object):
             data[:, index] = attribute
         return data
 
-    def evaluate_proposal(self, data, w ):  # BP with SGD (Stocastic BP)
+    def evaluate_proposal(self, data, w, batch=True):  # BP with SGD (Stocastic BP)
 
         self.decode(w)  # method to decode w into W1, W2, B1, B2.
         size = data.shape[0]
 
         Input = np.zeros((1, self.Top[0]))  # temp hold input
         Desired = np.zeros((1, self.Top[2]))
-        fx = np.zeros((size,self.Top[2]))
+        fx = np.zeros((size,self.Top[2]), dtype=self.w.dtype)
+
+        if batch:  # one matrix-matrix pass over the whole data block
+            self.ForwardPass(data[:, 0:self.Top[0]])
+            fx[:] = self.out
+            return fx
 
         for i in range(0, size):  # to see what fx is produced by your current weight update
             Input = data[i, 0:self.Top[0]]
@@ -142,16 +147,19 @@ class Network(object):
 
 # ------------------------------------------------------- MCMC Class --------------------------------------------------
 class BayesianTL(object):
-    def __init__(self, num_samples, num_sources, train_data, test_data, target_train_data, target_test_data, topology, directory, type='regression'):
+    def __init__(self, num_samples, num_sources, train_data, test_data, target_train_data, target_test_data, topology, directory, type='regression', precision='float64'):
         self.num_samples = num_samples  # NN topology [input, hidden, output]
         self.source_topology = topology  # max epocs
-        self.source_train_data = train_data  #
-        self.source_test_data = test_data
-        self.target_train_data = target_train_data
-        self.target_test_data = target_test_data
+        self.dtype = np.dtype(precision)  # 'float32' halves memory traffic; likelihoods and MH ratios stay in float64
+        self.source_train_data = [data.astype(self.dtype, copy=False) for data in train_data]  #
+        self.source_test_data = [data.astype(self.dtype, copy=False) for data in test_data]
+        self.target_train_data = target_train_data.astype(self.dtype, copy=False)
+        self.target_test_data = target_test_data.astype(self.dtype, copy=False)
         self.num_sources = num_sources
         self.type = type
         self.directory = directory
+        self.progress_interval = 0.5  # seconds between curses redraws in report_progress
+        self.last_report = 0
         # Create file objects to write the attributes of the samples
         self.source_wsize = (topology[0] * topology[1]) + (topology[1] * topology[2]) + topology[1] + topology[2]
         self.create_networks()
@@ -166,6 +174,10 @@ class BayesianTL(object):
 
 
     def report_progress(self, stdscr, sample_count, elapsed, rmse_train_source, rmse_test_source, rmse_train_target, rmse_test_target, rmse_train_target_trf, rmse_test_target_trf, last_transfer_sample, last_transfer_rmse, source_index, naccept_target_trf):
+        # called every sample, redraws at most every progress_interval seconds and on the last sample
+        if time.time() - self.last_report < self.progress_interval and sample_count < self.num_samples - 2:
+            return
+        self.last_report = time.time()
         stdscr.addstr(0, 0, "{} Samples Processed: {}/{} \tTime Elapsed: {}:{}".format(self.directory, sample_count, self.num_samples, elapsed[0], elapsed[1]))
         i = 2
         index = 0
@@ -188,14 +200,14 @@ class BayesianTL(object):
     def create_networks(self):
         self.sources = []
         for index in range(self.num_sources):
-            self.sources.append(Network(self.source_topology, self.source_train_data[index], self.source_test_data[index]))
+            self.sources.append(Network(self.source_topology, self.source_train_data[index], self.source_test_data[index], dtype=self.dtype))
         self.target_topology = self.source_topology.copy()
         self.target_topology[1] = int(1.0 * self.source_topology[1])
-        self.target = Network(self.target_topology, self.target_train_data, self.target_test_data)
+        self.target = Network(self.target_topology, self.target_train_data, self.target_test_data, dtype=self.dtype)
 
     @staticmethod
     def calculate_rmse(predictions, desired):
-        return np.sqrt(((predictions - desired) ** 2).mean())
+        return np.sqrt(np.mean(np.square(predictions - desired), dtype=np.float64))
 
     @staticmethod
     def calculate_nmse(predictions, desired):
@@ -224,23 +236,14 @@ class BayesianTL(object):
 
     @staticmethod
     def multinomial_likelihood(neural_network, data, weights):
-        y = data[:, neural_network.Top[0]: neural_network.top[2]]
-        fx = neuralnet.evaluate_proposal(data, weights)
-        rmse = self.calculate_rmse(fx, y) # Can be replaced by calculate_nmse function for reporting NMSE
-        probability = neural_network.softmax(fx)
-        loss = 0
-        for index_1 in range(y.shape[0]):
-            for index_2 in range(y.shape[1]):
-                if y[index_1, index_2] == 1:
-                    loss += np.log(probability[index_1, index_2] + 0.0001)
-
-        out = np.argmax(fx, axis=1)
-        y_out = np.argmax(y, axis=1)
-        count = 0
-        for index in range(y_out.shape[0]):
-            if out[index] == y_out[index]:
-                count += 1
-        accuracy = float(count)/y_out.shape[0] * 100
+        y = data[:, neural_network.Top[0]: neural_network.Top[0] + neural_network.Top[2]]
+        fx = neural_network.evaluate_proposal(data, weights)
+        rmse = BayesianTL.calculate_rmse(fx, y) # Can be replaced by calculate_nmse function for reporting NMSE
+        # cross-entropy of the one-hot targets under a log-softmax, shifted by the row max so exp cannot overflow
+        shifted = fx - np.max(fx, axis=1, keepdims=True)
+        log_probability = shifted - np.log(np.sum(np.exp(shifted), axis=1, keepdims=True))
+        loss = np.sum(y * log_probability, dtype=np.float64)
+        accuracy = np.mean(np.argmax(fx, axis=1) == np.argmax(y, axis=1)) * 100
         return [loss, rmse, accuracy]
 
     @staticmethod
@@ -248,7 +251,7 @@ class BayesianTL(object):
         # h = self.topology[1]  # number hidden neurons
         # d = self.topology[0]  # number input neurons
         part1 = -1 * ((weights.shape[0]) / 2) * np.log(sigma_squared)
-        part2 = 1 / (2 * sigma_squared) * (sum(np.square(weights)))
+        part2 = 1 / (2 * sigma_squared) * np.sum(np.square(weights), dtype=np.float64)
         log_loss = part1 - part2
         return log_loss
 
@@ -262,13 +265,15 @@ class BayesianTL(object):
         # np.savetxt('y.txt', y, delimiter=',')
         # rmse = self.distance(fx_m, y_m)
         rmse = BayesianTL.calculate_rmse(prediction, desired)
-        loss = -0.5 * np.log(2 * np.pi * tausq) - 0.5 * np.square(desired - prediction) / tausq
+        # accumulate in float64 whatever the working dtype
+        sq_error = np.square(desired - prediction)
+        loss = -0.5 * np.log(2 * np.pi * tausq) * sq_error.size - 0.5 * np.sum(sq_error, dtype=np.float64) / tausq
         return [np.sum(loss), rmse]
 
     @staticmethod
     def gaussian_prior(sigma_squared, nu_1, nu_2, weights, tausq):
         part1 = -1 * (weights.shape[0] / 2) * np.log(sigma_squared)
-        part2 = 1 / (2 * sigma_squared) * (sum(np.square(weights)))
+        part2 = 1 / (2 * sigma_squared) * np.sum(np.square(weights), dtype=np.float64)
         log_loss = part1 - part2 - (1 + nu_1) * np.log(tausq) - (nu_2 / tausq)
         return log_loss
 
@@ -391,8 +396,8 @@ class BayesianTL(object):
         source_rmse_test_sample = np.zeros(source_rmse_test.shape)
         source_train_size = np.zeros((self.num_sources))
         source_test_size = np.zeros((self.num_sources))
-        source_weights_current = np.zeros((self.num_sources, self.source_wsize))
-        source_weights_proposal = np.zeros((self.num_sources, self.source_wsize))
+        source_weights_current = np.zeros((self.num_sources, self.source_wsize), dtype=self.dtype)
+        source_weights_proposal = np.zeros((self.num_sources, self.source_wsize), dtype=self.dtype)
 
         source_prediction_train = []
         source_prediction_test = []
@@ -416,7 +421,7 @@ class BayesianTL(object):
             source_weights_proposal[index] = source_weights_initial
             source_prediction_train.append(self.sources[index].evaluate_proposal(self.source_train_data[index], source_weights_current[index]))
             source_prediction_test.append(self.sources[index].evaluate_proposal(self.source_test_data[index], source_weights_current[index]))
-            source_eta[index] = np.log(np.var(source_prediction_train[index] - source_y_train[index]))
+            source_eta[index] = np.log(np.var(source_prediction_train[index] - source_y_train[index], dtype=np.float64))
             source_tau_proposal[index] = np.exp(source_eta[index])
             source_prior[index] = self.prior_function(source_weights_current[index], source_tau_proposal[index])  # takes care of the gradients
             [source_likelihood[index], source_rmse_train[index]] = self.likelihood_function(self.sources[index], self.source_train_data[index], source_weights_current[index], source_tau_proposal[index])
@@ -429,11 +434,11 @@ class BayesianTL(object):
         target_test_size = self.target_test_data.shape[0]
         target_y_test = self.target_test_data[:, self.target_topology[0]: self.target_topology[0] + self.target_topology[2]]
         target_y_train = self.target_train_data[:, self.target_topology[0]: self.target_topology[0] + self.target_topology[2]]
-        target_weights_current = target_weights_initial
-        target_weights_proposal = target_weights_initial
+        target_weights_current = target_weights_initial.astype(self.dtype)
+        target_weights_proposal = target_weights_current
         target_prediction_train = self.target.evaluate_proposal(self.target_train_data, target_weights_current)
         target_prediction_test = self.target.evaluate_proposal(self.target_test_data, target_weights_current)
-        target_eta = np.log(np.var(target_prediction_train - target_y_train))
+        target_eta = np.log(np.var(target_prediction_train - target_y_train, dtype=np.float64))
         target_tau_proposal = np.exp(target_eta)
         target_prior = self.prior_function(target_weights_current, target_tau_proposal)
         [target_likelihood, target_rmse_train] = self.likelihood_function(self.target, self.target_train_data, target_weights_current, target_tau_proposal)
@@ -495,8 +500,8 @@ class BayesianTL(object):
 
         for sample in range(self.num_samples - 1):
 
-            source_weights_proposal = source_weights_current + np.random.normal(0, self.weights_stepsize, self.source_wsize)
-            target_weights_proposal = target_weights_current + np.random.normal(0, self.weights_stepsize, self.target_wsize)
+            source_weights_proposal = source_weights_current + np.random.normal(0, self.weights_stepsize, self.source_wsize).astype(self.dtype)
+            target_weights_proposal = target_weights_current + np.random.normal(0, self.weights_stepsize, self.target_wsize).astype(self.dtype)
 
             source_eta_proposal = source_eta + np.random.normal(0, self.eta_stepsize, 1)
             target_eta_proposal = target_eta + np.random.normal(0, self.eta_stepsize, 1)
@@ -505,7 +510,7 @@ class BayesianTL(object):
             target_tau_proposal = np.exp(target_eta_proposal)
 
             if transfer == True:
-                target_trf_weights_proposal = target_trf_weights_current + np.random.normal(0, self.weights_stepsize, self.target_wsize)
+                target_trf_weights_proposal = target_trf_weights_current + np.random.normal(0, self.weights_stepsize, self.target_wsize).astype(self.dtype)
                 target_trf_eta_proposal = target_trf_eta + np.random.normal(0, self.eta_stepsize, 1)
                 target_trf_tau_proposal = np.exp(target_trf_eta_proposal)
 
@@ -3,55 +3,116 @@
 
 from __future__ import print_function, division
 import multiprocessing
+import threading
+from multiprocessing import shared_memory
 import os
 import sys
 import gc
+import json
 import numpy as np
-import random
 import time
 import operator
 import math
-import matplotlib as mpl
-import matplotlib.mlab as mlab
-import matplotlib.pyplot as plt
-from matplotlib.patches import Polygon
-from matplotlib.collections import PatchCollection
-from scipy.stats import multivariate_normal
-from scipy.stats import norm
+#matplotlib and scipy are imported where they are used, so replicas start without them
 
 #np.random.seed(1)
 
+class SparseInputs(object):
+	#Input block stored as CSR of its deviations from the most common value, e.g. the RSSI of an undetected WAP in UJIndoorLoc
+	def __init__(self, X):
+		from scipy import sparse
+		values, counts = np.unique(X, return_counts=True)
+		self.baseline = values[np.argmax(counts)]
+		self.matrix = sparse.csr_matrix(X - self.baseline)
+		self.shape = X.shape
+		self.density = self.matrix.nnz / float(X.size)
+
+	def dot(self, W):
+		# X.dot(W) = (X - b).dot(W) + b * column sums of W, only the stored entries are touched
+		z = self.matrix.dot(W)
+		if self.baseline != 0:
+			z += self.baseline * W.sum(axis=0)
+		return z
+
+	def tdot(self, D):
+		# X.T.dot(D) from the same stored entries, for the first layer gradient
+		g = self.matrix.T.dot(D)
+		if self.baseline != 0:
+			g += self.baseline * D.sum(axis=0)
+		return g
+
+	def take(self, rows):
+		# the same view restricted to a subset of rows
+		subset = SparseInputs.__new__(SparseInputs)
+		subset.baseline = self.baseline
+		subset.matrix = self.matrix[rows]
+		subset.shape = subset.matrix.shape
+		subset.density = self.density
+		return subset
+
+def num_weights(topology):
+	# length of the flat w for [input, hidden..., output]: every layer's weights, then every layer's biases
+	return sum(topology[k] * topology[k + 1] for k in range(len(topology) - 1)) + sum(topology[1:])
+
+def sparse_inputs(data, num_inputs, threshold):
+	# CSR view of the input columns when their density is under threshold, None keeps the dense path
+	inputs = SparseInputs(data[:, 0:num_inputs])
+	if inputs.density < threshold:
+		return inputs
+	return None
+
 #REGRESSION FNN Randomwalk (Taken from R. Chandra, L. Azizi, S. Cripps, 'Bayesian neural learning via Langevin dynamicsfor chaotic time series prediction', ICONIP 2017.)
 
 class Network(object):
 
-	def __init__(self, Topo, Train, Test, learn_rate):
+	def __init__(self, Topo, Train, Test, learn_rate, dtype=np.float64, rng=None):
 		self.Top = Topo  # NN topology [input, hidden, output]
 		self.TrainData = Train
 		self.TestData = Test
 		self.lrate = learn_rate
+		self.rng = np.random.default_rng() if rng is None else rng  # the owning replica's Generator
 
-		self.W1 = np.random.randn(self.Top[0], self.Top[1]) / np.sqrt(self.Top[0])
-		self.B1 = np.random.randn(1, self.Top[1]) / np.sqrt(self.Top[1])  # bias first layer
-		self.W2 = np.random.randn(self.Top[1], self.Top[2]) / np.sqrt(self.Top[1])
-		self.B2 = np.random.randn(1, self.Top[2]) / np.sqrt(self.Top[1])  # bias second layer
+		#One contiguous parameter buffer in the flat w layout [W1, W2, B1, B2]; the layer matrices are permanent views into it
+		w_layer1size = self.Top[0] * self.Top[1]
+		w_layer2size = self.Top[1] * self.Top[2]
+		b_start = w_layer1size + w_layer2size
+		self.w = np.zeros(b_start + self.Top[1] + self.Top[2], dtype=dtype)
+		self.W1 = self.w[0:w_layer1size].reshape(self.Top[0], self.Top[1])
+		self.W2 = self.w[w_layer1size:b_start].reshape(self.Top[1], self.Top[2])
+		self.B1 = self.w[b_start:b_start + self.Top[1]]  # bias first layer
+		self.B2 = self.w[b_start + self.Top[1]:]  # bias second layer
+
+		self.W1[:] = self.rng.standard_normal((self.Top[0], self.Top[1])) / np.sqrt(self.Top[0])
+		self.B1[:] = self.rng.standard_normal(self.Top[1]) / np.sqrt(self.Top[1])
+		self.W2[:] = self.rng.standard_normal((self.Top[1], self.Top[2])) / np.sqrt(self.Top[1])
+		self.B2[:] = self.rng.standard_normal(self.Top[2]) / np.sqrt(self.Top[1])
+
+		#Blocks for block-wise proposals, as flat indices into w: hidden unit j's fan-in (W1[:, j], B1[j]) and fan-out (W2[j, :]),
+		#then the whole output layer (W2, B2)
+		index = np.arange(self.w.size)
+		W1_index = index[0:w_layer1size].reshape(self.Top[0], self.Top[1])
+		W2_index = index[w_layer1size:b_start].reshape(self.Top[1], self.Top[2])
+		self.blocks = [np.concatenate([W1_index[:, j], [b_start + j], W2_index[j]]) for j in range(self.Top[1])]
+		self.blocks.append(np.concatenate([W2_index.ravel(), index[b_start + self.Top[1]:]]))
 
 		self.hidout = np.zeros((1, self.Top[1]))  # output of first hidden layer
 		self.out = np.zeros((1, self.Top[2]))  # output last layer
 
 	@staticmethod
 	def sigmoid(x):
-		x = x.astype(np.float128)
-		return 1 / (1 + np.exp(-x))
+		# stable logistic in the working dtype of x: exp only sees -|x|, so it never overflows
+		e = np.exp(-np.abs(x))
+		r = 1 / (1 + e)
+		return np.where(x >= 0, r, e * r)
 
 	def sampleEr(self, actualout):
 		error = np.subtract(self.out, actualout)
-		sqerror = np.sum(np.square(error)) / self.Top[2]
+		sqerror = np.sum(np.square(error)) / self.Top[-1]
 		return sqerror
 
 	def sampleAD(self, actualout):
 		error = np.subtract(self.out, actualout)
-		moderror = np.sum(np.abs(error)) / self.Top[2]
+		moderror = np.sum(np.abs(error)) / self.Top[-1]
 		return moderror
 
 	def ForwardPass(self, X):
@@ -84,23 +145,62 @@ class Network(object):
 		# 	self.B1[y] += -1 * self.lrate * hid_delta[y]
 
 	def decode(self, w):
-		w_layer1size = self.Top[0] * self.Top[1]
-		w_layer2size = self.Top[1] * self.Top[2]
-
-		w_layer1 = w[0:w_layer1size]
-		self.W1 = np.reshape(w_layer1, (self.Top[0], self.Top[1]))
-
-		w_layer2 = w[w_layer1size:w_layer1size + w_layer2size]
-		self.W2 = np.reshape(w_layer2, (self.Top[1], self.Top[2]))
-		self.B1 = w[w_layer1size + w_layer2size:w_layer1size + w_layer2size + self.Top[1]]
-		self.B2 = w[w_layer1size + w_layer2size + self.Top[1]:w_layer1size + w_layer2size + self.Top[1] + self.Top[2]]
-
+		# copy w into the parameter buffer, the W1, W2, B1, B2 views pick it up without reslicing
+		if w is not self.w:
+			np.copyto(self.w, w)
 
 	def encode(self):
-		w1 = self.W1.ravel()
-		w2 = self.W2.ravel()
-		w = np.concatenate([w1, w2, self.B1, self.B2])
-		return w
+		# the buffer itself, not a copy: callers that keep it across decode() calls must copy it
+		return self.w
+
+	def propose(self, w, step, noise=None):
+		# random-walk proposal w + N(0, step) written straight into the parameter buffer, no per-call allocation;
+		# noise is a pre-drawn standard normal vector (see NoiseStream), drawn here when not given
+		if noise is None:
+			self.rng.standard_normal(out=self.w, dtype=self.w.dtype)
+			self.w *= step
+		else:
+			np.multiply(noise, step, out=self.w)
+		self.w += w
+		return self.w
+
+	def propose_block(self, w, step, block, noise=None):
+		# w with only the given block perturbed by N(0, step), written into the parameter buffer
+		np.copyto(self.w, w)
+		index = self.blocks[block]
+		if noise is None:
+			noise = self.rng.standard_normal(index.size, dtype=self.w.dtype)
+		self.w[index] += step * noise[:index.size]
+		return self.w
+
+	def forward_cache(self, X, w):
+		# hidden activations and output pre-activations of w on X, the state evaluate_block updates from
+		self.decode(w)
+		hidout = self.sigmoid(X.dot(self.W1) - self.B1)
+		z2 = hidout.dot(self.W2) - self.B2
+		return [hidout, z2]
+
+	def evaluate_block(self, X, cache, w, block, w_current):
+		# outputs of w, which differs from the cached w_current only inside block; returns fx and the cache update for commit_block
+		self.decode(w)
+		hidout, z2 = cache
+		if block == self.Top[1]:  # output layer: the hidden activations are unchanged
+			z2 = hidout.dot(self.W2) - self.B2
+			return self.sigmoid(z2), (None, None, z2)
+		j = block
+		W2_current = w_current[self.Top[0] * self.Top[1] + j * self.Top[2]:self.Top[0] * self.Top[1] + (j + 1) * self.Top[2]]
+		hidden = self.sigmoid(X.dot(self.W1[:, j:j + 1]) - self.B1[j])
+		#Rank-one correction of the output pre-activations for the new column j: O(N * (in + out)) instead of O(N * in * hidden)
+		z2 = z2 + hidden * self.W2[j] - hidout[:, j:j + 1] * W2_current
+		return self.sigmoid(z2), (j, hidden, z2)
+
+	@staticmethod
+	def commit_block(cache, update):
+		# move the cache to the accepted state
+		j, hidden, z2 = update
+		if j is not None:
+			cache[0][:, j] = hidden[:, 0]
+		cache[1] = z2
 
 	@staticmethod
 	def scaler(data, maxout=1, minout=0, maxin=1, minin=0):
@@ -143,18 +243,39 @@ class Network(object):
 				self.ForwardPass(Input)
 				self.BackwardPass(Input, Desired)
 
-		w_updated = self.encode()
+		w_updated = self.encode().copy()  # detach from the parameter buffer
 
 		return  w_updated
 
-	def evaluate_proposal(self, data, w ):  # BP with SGD (Stocastic BP)
+	def evaluate_gradient(self, data, w, tau_sq, temperature, sigma_squared, inputs=None):
+		# full-batch gradient in w of the tempered log-posterior loglik/temperature + log prior, one vectorized backward pass
+		self.decode(w)
+		X = data[:, 0:self.Top[0]] if inputs is None else inputs
+		self.ForwardPass(X)  # leaves fx in self.out
+		out_delta = (data[:, self.Top[0]:] - self.out) * (self.out * (1 - self.out)) / (tau_sq * temperature)
+		hid_delta = out_delta.dot(self.W2.T) * (self.hidout * (1 - self.hidout))
+		W1_grad = X.T.dot(hid_delta) if inputs is None else inputs.tdot(hid_delta)
+		grad = np.concatenate([W1_grad.ravel(), self.hidout.T.dot(out_delta).ravel(), -hid_delta.sum(axis=0), -out_delta.sum(axis=0)])
+		return grad - w / sigma_squared
+
+	def evaluate_proposal(self, data, w, batch=True, inputs=None):  # BP with SGD (Stocastic BP)
 
 		self.decode(w)  # method to decode w into W1, W2, B1, B2.
 		size = data.shape[0]
 
 		Input = np.zeros((1, self.Top[0]))  # temp hold input
-		Desired = np.zeros((1, self.Top[2]))
-		fx = np.zeros((size, self.Top[2]))
+		Desired = np.zeros((1, self.Top[-1]))
+		fx = np.zeros((size, self.Top[-1]), dtype=self.w.dtype)
+
+		if inputs is not None:  # sparse first layer, SparseInputs.dot stands in for the dense X.dot(W1)
+			self.ForwardPass(inputs)
+			fx[:] = self.out
+			return fx
+
+		if batch:  # one matrix-matrix pass over the whole data block
+			self.ForwardPass(data[:, 0:self.Top[0]])
+			fx[:] = self.out
+			return fx
 
 		for i in range(0, size):  # to see what fx is produced by your current weight update
 			Input = data[i, 0:self.Top[0]]
@@ -163,43 +284,398 @@ class Network(object):
 
 		return fx
 
+	def evaluate_proposals(self, data, w_stack, inputs=None):  # K proposals stacked as rows of a (K, w_size) array
+		K = w_stack.shape[0]
+		w_layer1size = self.Top[0] * self.Top[1]
+		w_layer2size = self.Top[1] * self.Top[2]
+		b_start = w_layer1size + w_layer2size
+
+		W1 = w_stack[:, 0:w_layer1size].reshape(K, self.Top[0], self.Top[1])
+		W2 = w_stack[:, w_layer1size:b_start].reshape(K, self.Top[1], self.Top[2])
+		B1 = w_stack[:, b_start:b_start + self.Top[1]]
+		B2 = w_stack[:, b_start + self.Top[1]:b_start + self.Top[1] + self.Top[2]]
+
+		#Batched matmul over the 3-D weight tensors: (N, in) x (K, in, h) -> (K, N, h)
+		if inputs is not None:
+			#One sparse product against the K first layers laid side by side: (N, in) x (in, K*h)
+			z1 = inputs.dot(W1.transpose(1, 0, 2).reshape(self.Top[0], K * self.Top[1]))
+			z1 = z1.reshape(-1, K, self.Top[1]).transpose(1, 0, 2)
+		else:
+			z1 = np.matmul(data[:, 0:self.Top[0]], W1)
+		hidout = self.sigmoid(z1 - B1[:, np.newaxis, :])
+		fx = self.sigmoid(np.matmul(hidout, W2) - B2[:, np.newaxis, :])
+		return fx
+
+class DeepNetwork(Network):
+	#Any number of hidden layers, Topo = [input, hidden_1, ..., hidden_k, output]. The flat w is all layer weights then all
+	#biases, [W1, ..., WL, B1, ..., BL], which is the [W1, W2, B1, B2] layout of Network for a single hidden layer
+	def __init__(self, Topo, Train, Test, learn_rate, dtype=np.float64, rng=None):
+		self.Top = Topo
+		self.TrainData = Train
+		self.TestData = Test
+		self.lrate = learn_rate
+		self.rng = np.random.default_rng() if rng is None else rng
+
+		self.w = np.zeros(num_weights(Topo), dtype=dtype)
+		self.weights = []  # views into self.w, like W1 and W2 in Network
+		self.biases = []
+		start = 0
+		for k in range(len(Topo) - 1):
+			self.weights.append(self.w[start:start + Topo[k] * Topo[k + 1]].reshape(Topo[k], Topo[k + 1]))
+			start += Topo[k] * Topo[k + 1]
+		for k in range(1, len(Topo)):
+			self.biases.append(self.w[start:start + Topo[k]])
+			start += Topo[k]
+		for W, B in zip(self.weights, self.biases):
+			W[:] = self.rng.standard_normal(W.shape) / np.sqrt(W.shape[0])
+			B[:] = self.rng.standard_normal(B.size) / np.sqrt(W.shape[0])
+
+		self.hidden = []  # activations of every hidden layer from the last ForwardPass
+		self.out = np.zeros((1, self.Top[-1]))  # output last layer
+
+	def ForwardPass(self, X):
+		self.hidden = []
+		for W, B in zip(self.weights[:-1], self.biases[:-1]):
+			X = self.sigmoid(X.dot(W) - B)
+			self.hidden.append(X)
+		self.hidout = X
+		self.out = self.sigmoid(X.dot(self.weights[-1]) - self.biases[-1])
+
+	def evaluate_gradient(self, data, w, tau_sq, temperature, sigma_squared, inputs=None):
+		# same as Network.evaluate_gradient, backpropagated through every layer
+		self.decode(w)
+		X = data[:, 0:self.Top[0]] if inputs is None else inputs
+		self.ForwardPass(X)
+		activations = [X] + self.hidden
+		delta = (data[:, self.Top[0]:] - self.out) * (self.out * (1 - self.out)) / (tau_sq * temperature)
+		weight_grads = []
+		bias_grads = []
+		for k in reversed(range(len(self.weights))):
+			A = activations[k]
+			weight_grads.insert(0, inputs.tdot(delta) if k == 0 and inputs is not None else A.T.dot(delta))
+			bias_grads.insert(0, -delta.sum(axis=0))
+			if k > 0:
+				delta = delta.dot(self.weights[k].T) * (A * (1 - A))
+		grad = np.concatenate([g.ravel() for g in weight_grads + bias_grads])
+		return grad - w / sigma_squared
+
+	def evaluate_proposals(self, data, w_stack, inputs=None):  # K proposals stacked as rows of a (K, w_size) array
+		K = w_stack.shape[0]
+		weights = []
+		biases = []
+		start = 0
+		for k in range(len(self.Top) - 1):
+			weights.append(w_stack[:, start:start + self.Top[k] * self.Top[k + 1]].reshape(K, self.Top[k], self.Top[k + 1]))
+			start += self.Top[k] * self.Top[k + 1]
+		for k in range(1, len(self.Top)):
+			biases.append(w_stack[:, start:start + self.Top[k]])
+			start += self.Top[k]
+
+		if inputs is not None:
+			z = inputs.dot(weights[0].transpose(1, 0, 2).reshape(self.Top[0], K * self.Top[1]))
+			z = z.reshape(-1, K, self.Top[1]).transpose(1, 0, 2)
+		else:
+			z = np.matmul(data[:, 0:self.Top[0]], weights[0])
+		fx = self.sigmoid(z - biases[0][:, np.newaxis, :])
+		for W, B in zip(weights[1:], biases[1:]):
+			fx = self.sigmoid(np.matmul(fx, W) - B[:, np.newaxis, :])
+		return fx
+
+class NoiseStream(object):
+	#Standard normal proposal noise from one Generator, drawn a block of rows at a time and handed out a row per iteration
+	def __init__(self, rng, size, dtype, block_elements=1 << 20):
+		self.rng = rng
+		self.block = np.empty((max(1, block_elements // size), size), dtype=dtype)
+		self.row = self.block.shape[0]
+
+	def draw(self):
+		# the returned row is only valid until the next call
+		if self.row == self.block.shape[0]:
+			self.rng.standard_normal(out=self.block, dtype=self.block.dtype)
+			self.row = 0
+		self.row += 1
+		return self.block[self.row - 1]
+
+class StepStream(object):
+	#The per-iteration scalars of ptReplica.run, eta step, MH uniform and the proposal block when there are blocks, drawn
+	#from one Generator a block of iterations at a time like NoiseStream, so none of them grows with the number of samples
+	def __init__(self, rng, step_eta, num_blocks=None, block_size=1 << 16):
+		self.rng = rng
+		self.step_eta = step_eta
+		self.num_blocks = num_blocks
+		self.block_size = block_size
+		self.row = block_size
+
+	def draw(self):
+		if self.row == self.block_size:
+			self.eta_steps = self.rng.normal(0, self.step_eta, self.block_size)
+			self.uniforms = self.rng.uniform(0, 1, self.block_size)
+			if self.num_blocks is not None:
+				self.blocks = self.rng.integers(self.num_blocks, size=self.block_size)
+			self.row = 0
+		self.row += 1
+		block = None if self.num_blocks is None else self.blocks[self.row - 1]
+		return self.eta_steps[self.row - 1], self.uniforms[self.row - 1], block
+
+#POSTERIOR FILES: magic, uint32 header length, JSON header padded to a 64 byte boundary, then raw C-order rows.
+#The row count is whatever the file holds, so writers only ever append and readers map the rows in place
+POSTERIOR_MAGIC = b'PTPOST\x01\x00'
+
+#One accept-log record per iteration of ptReplica.run, the temperature is in the file header. likelihood is tempered and
+#log_ratio is the Metropolis-Hastings log ratio the uniform was compared against, proposal term included
+ACCEPT_RECORD = np.dtype([('iteration', '<i8'), ('accepted', '?'), ('rmse_train', '<f8'), ('rmse_test', '<f8'), ('likelihood', '<f8'), ('log_ratio', '<f8')])
+
+class SampleWriter(object):
+	#One posterior array streamed to a posterior file a chunk of rows at a time, so memory stays flat in the number of samples.
+	#header carries the run metadata (topology, temperature, burn-in, ...) next to the dtype and row shape
+	def __init__(self, file_name, row_shape, dtype, header=None, chunk_bytes=1 << 22):
+		dtype = np.dtype(dtype)
+		header = dict(header or {}, dtype=np.lib.format.dtype_to_descr(dtype), row_shape=list(row_shape))
+		text = json.dumps(header).encode()
+		text += b' ' * (-(len(POSTERIOR_MAGIC) + 4 + len(text)) % 64)
+		self.file = open(file_name, 'wb')
+		self.file.write(POSTERIOR_MAGIC + np.uint32(len(text)).astype('<u4').tobytes() + text)
+		self.buffer = np.empty((max(1, chunk_bytes // (dtype.itemsize * max(1, int(np.prod(row_shape))))),) + tuple(row_shape), dtype=dtype)
+		self.rows = 0
+		self.count = 0
+
+	def append(self, row):
+		self.buffer[self.count] = row
+		self.count += 1
+		if self.count == self.buffer.shape[0]:
+			self.flush()
+
+	def flush(self):
+		if self.count:
+			self.file.write(self.buffer[:self.count].data)
+			self.rows += self.count
+			self.count = 0
+
+	def close(self):
+		self.flush()
+		self.file.close()
+
+def stored_rows(samples, burn_in, thin=1, keep_burn_in=True):
+	#Row j of a chain is kept when it is on the thinning grid counted from burn-in, and past burn-in unless keep_burn_in
+	burnin = int(samples*burn_in)
+	store = np.zeros(samples, dtype=bool)
+	store[burnin % thin if keep_burn_in else burnin::thin] = True
+	return store
+
+def read_posterior(file_name):
+	#Rows of a SampleWriter file as a read-only memmap, and its header; a partly written last row is left out
+	with open(file_name, 'rb') as f:
+		if f.read(len(POSTERIOR_MAGIC)) != POSTERIOR_MAGIC:
+			raise ValueError('{} is not a posterior file'.format(file_name))
+		length = int(np.frombuffer(f.read(4), dtype='<u4')[0])
+		header = json.loads(f.read(length).decode())
+	offset = len(POSTERIOR_MAGIC) + 4 + length
+	dtype = np.lib.format.descr_to_dtype(header['dtype'])
+	row_shape = tuple(header['row_shape'])
+	rows = (os.path.getsize(file_name) - offset) // (dtype.itemsize * int(np.prod(row_shape)))
+	if rows == 0:  # nothing to map
+		return np.zeros((0,) + row_shape, dtype=dtype), header
+	return np.memmap(file_name, dtype=dtype, mode='r', offset=offset, shape=(rows,) + row_shape), header
+
+#COMPUTE BACKENDS for ptReplica.likelihood_func and prior_likelihood, looked up by name in BACKENDS
+BACKENDS = {}
+
+def register_backend(name):
+	def register(cls):
+		cls.name = name
+		BACKENDS[name] = cls
+		return cls
+	return register
+
+def make_backend(name='auto'):
+	# 'auto' prefers the fused numba kernels; any backend whose optional dependency fails to import falls back to numpy
+	if name != 'auto' and name not in BACKENDS:
+		raise ValueError('unknown backend {!r}, registered: {}'.format(name, sorted(BACKENDS)))
+	for candidate in (['numba', 'numpy'] if name == 'auto' else [name, 'numpy']):
+		try:
+			return BACKENDS[candidate]()
+		except ImportError:
+			if name != 'auto':
+				print('backend {} is not available, falling back to numpy'.format(name))
+
+@register_backend('numpy')
+class NumpyBackend(object):
+
+	def gaussian_likelihood(self, fnn, data, w, tau_sq, inputs=None, fx=None):
+		# untempered log-likelihood of data under N(fx, tau_sq), with fx and the rmse
+		y = data[:, fnn.Top[0]:]
+		if fx is None:  # fx is passed in when it was already computed incrementally
+			fx = fnn.evaluate_proposal(data, w, inputs=inputs)
+		#Accumulate in float64 whatever the working dtype, the MH ratio is a small difference of large sums
+		sq_error = np.square(y - fx)
+		total = np.sum(sq_error, dtype=np.float64)
+		loss = -0.5*np.log(2*math.pi*tau_sq)*sq_error.size - 0.5*total/tau_sq
+		return [loss, fx, np.sqrt(total/sq_error.size)]
+
+	def sum_squares(self, w):
+		return np.sum(np.square(w), dtype=np.float64)
+
+def fused_gaussian_kernel(X, Y, W1, B1, W2, B2, fx):
+	# forward pass, residual and squared error sum one row at a time, with one hidden-layer row of scratch; compiled by NumbaBackend
+	hidden = np.empty(W1.shape[1], dtype=fx.dtype)
+	total = 0.0
+	for n in range(X.shape[0]):
+		for j in range(W1.shape[1]):
+			hidden[j] = -B1[j]
+		for k in range(X.shape[1]):
+			x = X[n, k]
+			if x != 0:
+				for j in range(W1.shape[1]):
+					hidden[j] += x * W1[k, j]
+		for j in range(W1.shape[1]):
+			z = hidden[j]
+			if z >= 0:
+				hidden[j] = 1 / (1 + np.exp(-z))
+			else:
+				hidden[j] = np.exp(z) / (1 + np.exp(z))
+		for o in range(W2.shape[1]):
+			z = -B2[o]
+			for j in range(W1.shape[1]):
+				z += hidden[j] * W2[j, o]
+			if z >= 0:
+				f = 1 / (1 + np.exp(-z))
+			else:
+				f = np.exp(z) / (1 + np.exp(z))
+			fx[n, o] = f
+			total += (Y[n, o] - f) * (Y[n, o] - f)
+	return total
+
+def sum_squares_kernel(w):
+	total = 0.0
+	for i in range(w.shape[0]):
+		total += w[i] * w[i]
+	return total
+
+@register_backend('numba')
+class NumbaBackend(NumpyBackend):
+	#Fused CPU kernels for the dense single hidden layer Network; other cases (DeepNetwork, sparse inputs, precomputed fx) use numpy
+	def __init__(self):
+		import numba
+		self.kernel = numba.njit(cache=True)(fused_gaussian_kernel)
+		self.sum_squares_kernel = numba.njit(cache=True)(sum_squares_kernel)
+
+	def gaussian_likelihood(self, fnn, data, w, tau_sq, inputs=None, fx=None):
+		if fx is not None or inputs is not None or type(fnn) is not Network:
+			return NumpyBackend.gaussian_likelihood(self, fnn, data, w, tau_sq, inputs=inputs, fx=fx)
+		fnn.decode(w)
+		fx = np.empty((data.shape[0], fnn.Top[-1]), dtype=fnn.w.dtype)
+		total = self.kernel(data[:, 0:fnn.Top[0]], data[:, fnn.Top[0]:], fnn.W1, fnn.B1, fnn.W2, fnn.B2, fx)
+		loss = -0.5*np.log(2*math.pi*tau_sq)*fx.size - 0.5*total/tau_sq
+		return [loss, fx, np.sqrt(total/fx.size)]
+
+	def sum_squares(self, w):
+		return self.sum_squares_kernel(w)
+
 class ptReplica(multiprocessing.Process):
 
-	def __init__(self, name, w, samples, traindata, testdata, topology, burn_in, temperature, swap_interval, path, parameter_queue, main_process,event):
+	def __init__(self, name, w, samples, traindata, testdata, topology, burn_in, temperature, swap_interval, path, state, main_process,event, dtype=np.float64, train_inputs=None, test_inputs=None, subsample=None, epsilon=0.05, block_proposals=False, langevin=False, test_interval=None, backend=None, rng=None, save_fx=False, thin=1, keep_burn_in=True, progress=None, state_row=0, labels=None, temperatures=None):
 		#MULTIPROCESSING VARIABLES
 		multiprocessing.Process.__init__(self)
 		self.processID = temperature
-		self.parameter_queue = parameter_queue
+		self.state = state  # SharedMemory swap table of the coordinator, this replica owns row state_row
+		self.state_row = state_row
+		#Label swapping: labels is the shared permutation, the ladder slot (index into temperatures) of every replica row.
+		#The state then stays in this process and only the temperature moves, so files are named by replica not temperature
+		self.labels = labels
+		self.temperatures = temperatures  # shared ladder of this task, re-read at every swap as adapt_ladder moves it
+		self.tag = str(temperature) if labels is None else 'replica_' + str(state_row % len(temperatures))
 		self.signal_main = main_process
 		self.event =  event
+		self.progress = progress  # shared RawArray [samples done, accepted, train rmse] the coordinator reports from
 		#PARALLEL TEMPERING VARIABLES
 		self.temperature = temperature
 		self.swap_interval = swap_interval
 		self.directory = path
 		self.burn_in = burn_in
+		self.thin = thin  # every thin-th sample from burn-in on is stored
+		self.keep_burn_in = keep_burn_in  # False stores nothing before burn-in
 		#FNN CHAIN VARIABLES (MCMC)
 		self.samples = samples
 		self.topology = topology
 		self.traindata = traindata
 		self.testdata = testdata
 		self.w = w
+		self.dtype = dtype  # working precision of the network, data, proposals and posterior buffers
+		self.train_inputs = train_inputs  # SparseInputs of the data blocks, None for the dense path
+		self.test_inputs = test_inputs
+		#SUBSAMPLED MH VARIABLES (None runs the exact test on the full train set)
+		self.subsample = subsample  # rows added to the subset per step of the sequential test
+		self.epsilon = epsilon  # tolerated probability of a wrong accept/reject decision per step
+		self.order = None  # train row order the subsets are drawn from, kept between tests
+		self.block_proposals = block_proposals  # perturb one hidden unit or the output layer per step, see Network.blocks
+		self.langevin = langevin  # MALA: random walk around the gradient step of the tempered posterior
+		self.test_interval = test_interval  # None evaluates the test set on accepted states only
+		self.backend = NumpyBackend() if backend is None else backend  # kernels behind likelihood_func and prior_likelihood
+		self.save_fx = save_fx  # also stream the train/test outputs of every sample to disk
+		self.rng = np.random.default_rng() if rng is None else rng  # this replica's own stream, see ParallelTemperingTL.seed_sequence
 		self.name = name
 
 	def rmse(self, pred, actual):
-		return np.sqrt(((pred-actual)**2).mean())
+		return np.sqrt(np.mean(np.square(pred-actual), dtype=np.float64))
 
-	def likelihood_func(self, fnn, data, w, tau_sq):
+	def likelihood_func(self, fnn, data, w, tau_sq, inputs=None, fx=None):
+		[loss, fx, rmse] = self.backend.gaussian_likelihood(fnn, data, w, tau_sq, inputs=inputs, fx=fx)
+		return [loss/self.temperature, fx, rmse]
+
+	def likelihood_batch(self, fnn, data, w_stack, tau_sq, inputs=None):
+		#Same as likelihood_func for K proposals at once; tau_sq is a scalar or one value per proposal
 		y = data[:, self.topology[0]:]
-		fx = fnn.evaluate_proposal(data,w)
-		rmse = self.rmse(fx, y)
-		loss = np.sum(-0.5*np.log(2*math.pi*tau_sq) - 0.5*np.square(y-fx)/tau_sq)
-		return [np.sum(loss)/self.temperature, fx, rmse]
+		fx = fnn.evaluate_proposals(data, w_stack, inputs=inputs)
+		tau_sq = np.reshape(tau_sq, (-1, 1, 1))
+		sq_error = np.square(y - fx)
+		rmse = np.sqrt(sq_error.mean(axis=(1, 2), dtype=np.float64))
+		loss = -0.5*np.log(2*math.pi*tau_sq[:, 0, 0])*y.size - 0.5*np.sum(sq_error, axis=(1, 2), dtype=np.float64)/tau_sq[:, 0, 0]
+		return [loss/self.temperature, fx, rmse]
+
+	def row_sq_error(self, fnn, data, w, inputs=None):
+		# per-row sum of squared errors over the outputs, accumulated in float64
+		fx = fnn.evaluate_proposal(data, w, inputs=inputs)
+		return np.sum(np.square(data[:, self.topology[0]:] - fx), axis=1, dtype=np.float64)
+
+	def subsampled_mh_test(self, fnn, w_proposal, tau_pro, tau_current, sq_current, threshold):
+		#Austerity MH (Korattikara, Chen & Welling 2014): compare the mean per-row tempered log-likelihood difference
+		#against threshold, growing a random subset without replacement until a t-test is confident at level epsilon
+		from scipy.special import stdtr  # Student t CDF, a much lighter import than scipy.stats
+		data = self.traindata
+		N = data.shape[0]
+		if self.order is None:
+			self.order = np.arange(N)
+		order = self.order  # order[:n] is the subset so far, order[n:] the rows not yet drawn
+		n = 0
+		mean = m2 = 0.0  # running mean and sum of squared deviations of the differences (Chan et al. batch update)
+		while True:
+			#Next batch without replacement, moved to order[n:n + b] by swapping, so a stage costs O(batch) whatever N
+			b = min(self.subsample, N - n)
+			picks = n + self.rng.choice(N - n, b, replace=False)
+			outside = picks[picks >= n + b]
+			vacant = np.setdiff1d(np.arange(n, n + b), picks, assume_unique=True)
+			order[outside], order[vacant] = order[vacant], order[outside]
+			rows = order[n:n + b]
+			inputs = None if self.train_inputs is None else self.train_inputs.take(rows)
+			sq_proposal = self.row_sq_error(fnn, data[rows], w_proposal, inputs=inputs)
+			diffs = (-0.5*self.topology[-1]*np.log(tau_pro/tau_current) - 0.5*sq_proposal/tau_pro + 0.5*sq_current[rows]/tau_current) / self.temperature
+			delta = np.mean(diffs) - mean
+			mean += delta * b / (n + b)
+			m2 += np.sum(np.square(diffs - np.mean(diffs))) + delta**2 * n * b / (n + b)
+			n += b
+			if n == N:
+				break
+			if n > 1:
+				se = np.sqrt(m2 / (n - 1)) / np.sqrt(n) * np.sqrt(1 - (n - 1) / (N - 1.0))  # finite population correction
+				if se == 0 or stdtr(n - 1, -abs(mean - threshold) / se) < self.epsilon:
+					break
+		return mean > threshold, mean*N, n
 
 	def prior_likelihood(self, sigma_squared, nu_1, nu_2, w, tausq):
 		h = self.topology[1]  # number hidden neurons
 		d = self.topology[0]  # number input neurons
 		part1 = -1 * ((d * h + h + 2) / 2) * np.log(sigma_squared)
-		part2 = 1 / (2 * sigma_squared) * (sum(np.square(w)))
+		part2 = 1 / (2 * sigma_squared) * self.backend.sum_squares(w)
 		log_loss = part1 - part2  - (1 + nu_1) * np.log(tausq) - (nu_2 / tausq)
 		return log_loss
 
@@ -209,37 +685,48 @@ class ptReplica(multiprocessing.Process):
 		trainsize = self.traindata.shape[0]
 		samples = self.samples
 		self.sgd_depth = 1
-		x_test = np.linspace(0,1,num=testsize)
-		x_train = np.linspace(0,1,num=trainsize)
 		netw = self.topology
 		y_test = self.testdata[:,netw[0]:]
 		y_train = self.traindata[:,netw[0]:]
 
-		w_size = (netw[0] * netw[1]) + (netw[1] * netw[2]) + netw[1] + netw[2]  # num of weights and bias
-		pos_w = np.ones((samples, w_size)) #Posterior for all weights
-		pos_tau = np.ones((samples,1)) #Tau is the variance of difference in predicted and actual values
-
-		fxtrain_samples = np.ones((samples, trainsize, netw[2])) #Output of regression FNN for training samples
-		fxtest_samples = np.ones((samples, testsize, netw[2])) #Output of regression FNN for testing samples
-		rmse_train  = np.zeros(samples)
-		rmse_test = np.zeros(samples)
+		w_size = num_weights(netw)  # num of weights and bias
+		store = stored_rows(samples, self.burn_in, self.thin, self.keep_burn_in)
+		num_stored = int(np.sum(store))
+		make_directory(self.directory+'/posterior')
+		header = {'topology': list(netw), 'temperature': self.temperature, 'burn_in': self.burn_in, 'thin': self.thin, 'keep_burn_in': self.keep_burn_in}
+		pos_w = SampleWriter(self.directory+'/posterior/pos_w_chain_'+ self.tag+ '.bin', (w_size,), self.dtype, header) #Posterior for all weights
+
+		if self.save_fx:
+			fxtrain_samples = SampleWriter(self.directory+'/posterior/fxtrain_samples_chain_'+ self.tag+ '.bin', (trainsize, netw[-1]), self.dtype, header) #Output of regression FNN for training samples
+			fxtest_samples = SampleWriter(self.directory+'/posterior/fxtest_samples_chain_'+ self.tag+ '.bin', (testsize, netw[-1]), self.dtype, header) #Output of regression FNN for testing samples
+		rmse_train  = np.zeros(num_stored)
+		rmse_test = np.zeros(num_stored)
+		rows_used = np.zeros(samples, dtype=int) #Train rows evaluated at each iteration: the accept/reject decision, plus a full pass over an accepted state in subsampled mode or a swapped-in one
+		if self.labels is not None:
+			slot = self.labels[self.state_row]
+			slots = np.full(samples, slot, dtype=int) #Ladder slot every row was sampled at
 		learn_rate = 0.5
 
 		naccept = 0
 		#Random Initialisation of weights
-		w = self.w
+		w = self.w.astype(self.dtype)
 		#print(w,self.temperature)
-		w_proposal = np.random.randn(w_size)
 		#Randomwalk Steps
 		step_w = 0.025
 		step_eta = 0.2
-		#Declare FNN
-		fnn = Network(self.topology, self.traindata, self.testdata, learn_rate)
+		#Declare FNN, DeepNetwork when there is more than one hidden layer
+		fnn = (Network if len(netw) == 3 else DeepNetwork)(self.topology, self.traindata, self.testdata, learn_rate, dtype=self.dtype, rng=self.rng)
+		w_proposal = fnn.encode()  # proposals live in the network's parameter buffer
+		#Row of the swap table, [w, eta, untempered likelihood, temperature] in float64
+		state = np.ndarray((w_size + 3,), dtype=np.float64, buffer=self.state.buf, offset=self.state_row * (w_size + 3) * 8)
+		#Proposal noise, eta steps, uniforms and blocks drawn a block at a time from the replica's Generator
+		noise = NoiseStream(self.rng, max(map(len, fnn.blocks)) if self.block_proposals else w_size, self.dtype)
+		steps = StepStream(self.rng, step_eta, len(fnn.blocks) if self.block_proposals else None)
 		#Evaluate Proposals
-		pred_train = fnn.evaluate_proposal(self.traindata,w)
-		pred_test = fnn.evaluate_proposal(self.testdata, w)
+		pred_train = fnn.evaluate_proposal(self.traindata,w, inputs=self.train_inputs)
+		pred_test = fnn.evaluate_proposal(self.testdata, w, inputs=self.test_inputs)
 		#Check Variance of Proposal
-		eta = np.log(np.var(pred_train - y_train))
+		eta = np.log(np.var(pred_train - y_train, dtype=np.float64))
 		tau_pro = np.exp(eta)
 		sigma_squared = 25
 		nu_1 = 0
@@ -247,151 +734,277 @@ class ptReplica(multiprocessing.Process):
 
 		delta_likelihood = 0.5 # an arbitrary position
 		prior_current = self.prior_likelihood(sigma_squared, nu_1, nu_2, w, tau_pro)  # takes care of the gradients
-		#Evaluate Likelihoods
-		[likelihood, pred_train, rmsetrain] = self.likelihood_func(fnn, self.traindata, w, tau_pro)
-		[_, pred_test, rmsetest] = self.likelihood_func(fnn, self.testdata, w, tau_pro)
+		#Evaluate Likelihoods, the train likelihood is kept untempered and divided by the temperature where it is compared
+		[likelihood, pred_train, rmsetrain] = self.backend.gaussian_likelihood(fnn, self.traindata, w, tau_pro, inputs=self.train_inputs)
+		[_, pred_test, rmsetest] = self.likelihood_func(fnn, self.testdata, w, tau_pro, inputs=self.test_inputs)
+		if self.subsample is not None:
+			sq_current = self.row_sq_error(fnn, self.traindata, w, inputs=self.train_inputs)
+		fx_train = fx_test = None
+		diff_prop = 0
+		if self.langevin:
+			grad_current = fnn.evaluate_gradient(self.traindata, w, tau_pro, self.temperature, sigma_squared, inputs=self.train_inputs)
+		if self.block_proposals:  # activations of the current state, rebuilt from scratch at every swap point
+			train_X = self.traindata[:, 0:netw[0]] if self.train_inputs is None else self.train_inputs
+			test_X = self.testdata[:, 0:netw[0]] if self.test_inputs is None else self.test_inputs
+			train_cache = fnn.forward_cache(train_X, w)
+			test_cache = fnn.forward_cache(test_X, w)
 		#Beginning Sampling using MCMC RANDOMWALK
-		plt.plot(x_train, y_train)
-
-		accept_list = open(self.directory+'/acceptlist_'+str(self.temperature)+'.txt', "a+")
 
+		accept_list = SampleWriter(self.directory+'/acceptlist_'+self.tag+'.bin', (), ACCEPT_RECORD, header)
+
+		#Values of the current row: the last accepted proposal and the last test evaluation, placeholders before either
+		w_record = np.ones(w_size, dtype=self.dtype)
+		rmsetrain_record = rmsetest_record = 0
+		if self.save_fx:
+			fxtrain_record = np.ones((trainsize, netw[-1]), dtype=self.dtype)
+			fxtest_record = np.ones((testsize, netw[-1]), dtype=self.dtype)
+		n = 0  # rows stored so far
+		progress = None if self.progress is None else np.frombuffer(self.progress)
+		if store[0]:
+			pos_w.append(w_record)
+			if self.save_fx:
+				fxtrain_samples.append(fxtrain_record)
+				fxtest_samples.append(fxtest_record)
+			n += 1
 
 		for i in range(samples - 1):
-			print('{} temperature: {:.2} sample: {}'.format(self.name, self.temperature, i))
+			if progress is not None:
+				progress[:] = i, naccept, rmsetrain_record
 			#GENERATING SAMPLE
-			w_proposal = np.random.normal(w, step_w, w_size) # Eq 7
-
-			eta_pro = eta + np.random.normal(0, step_eta, 1)
+			eta_step, u, block = steps.draw()
+			eta_pro = eta + eta_step
 			tau_pro = math.exp(eta_pro)
 
-			[likelihood_proposal, pred_train, rmsetrain] = self.likelihood_func(fnn, self.traindata, w_proposal,tau_pro)
+			if self.langevin:
+				w_gd = w + 0.5 * step_w**2 * grad_current # Eq 8
+				fnn.propose(w_gd, step_w, noise.draw())
+				grad_proposal = fnn.evaluate_gradient(self.traindata, w_proposal, tau_pro, self.temperature, sigma_squared, inputs=self.train_inputs)
+				fx_train = fnn.out
+				w_prop_gd = w_proposal + 0.5 * step_w**2 * grad_proposal
+				#log q(w | w_proposal) - log q(w_proposal | w) for the N(w_gd, step_w**2 I) proposal, Eq 9
+				diff_prop = (np.sum(np.square(w_proposal - w_gd), dtype=np.float64) - np.sum(np.square(w - w_prop_gd), dtype=np.float64)) / (2 * step_w**2)
+			elif self.block_proposals:
+				fnn.propose_block(w, step_w, block, noise.draw())
+				[fx_train, train_update] = fnn.evaluate_block(train_X, train_cache, w_proposal, block, w)
+			else:
+				fnn.propose(w, step_w, noise.draw()) # Eq 7, fills w_proposal in place
 
-			[_, pred_test, rmsetest] = self.likelihood_func(fnn, self.testdata, w_proposal,tau_pro)
 			prior_prop = self.prior_likelihood(sigma_squared, nu_1, nu_2, w_proposal,tau_pro)  # takes care of the gradients
 			diff_prior = prior_prop - prior_current
-			diff_likelihood = likelihood_proposal - likelihood
 			#ACCEPTANCE OF SAMPLE
 
-			try:
-				mh_prob = min(1, math.exp(min(709, diff_likelihood + diff_prior)))
-			except OverflowError:
-				mh_prob = 1
-
-			u = random.uniform(0, 1)
-
-
-			if u < mh_prob:
+			if self.subsample is None:
+				[likelihood_proposal, pred_train, rmsetrain] = self.backend.gaussian_likelihood(fnn, self.traindata, w_proposal,tau_pro, inputs=self.train_inputs, fx=fx_train)
+				diff_likelihood = (likelihood_proposal - likelihood) / self.temperature
+				log_ratio = diff_likelihood + diff_prior + diff_prop  # what the accept log records
+				try:
+					mh_prob = min(1, math.exp(min(709, log_ratio)))
+				except OverflowError:
+					mh_prob = 1
+				accept = u < mh_prob
+				rows_used[i + 1] = trainsize
+			else:
+				#SEQUENTIAL TEST ON SUBSETS: accept iff mean difference > (log u - diff_prior)/N, as in the exact test
+				accept, diff_likelihood, rows_used[i + 1] = self.subsampled_mh_test(fnn, w_proposal, tau_pro, math.exp(eta), sq_current, (np.log(u) - diff_prior) / trainsize)
+				log_ratio = diff_likelihood + diff_prior  # accepted iff above log u, the same test on the subset estimate
+				rmsetrain = np.nan
+				if accept:  # the accepted state is evaluated in full for the records and the swaps
+					[likelihood_proposal, pred_train, rmsetrain] = self.backend.gaussian_likelihood(fnn, self.traindata, w_proposal,tau_pro, inputs=self.train_inputs)
+					sq_current = np.sum(np.square(y_train - pred_train), axis=1, dtype=np.float64)
+					rows_used[i + 1] += trainsize
+
+			#TEST SET: only the state the chain moves to is evaluated, when accepted or every test_interval iterations
+			if accept and self.block_proposals:
+				[fx_test, test_update] = fnn.evaluate_block(test_X, test_cache, w_proposal, block, w)
+				fnn.commit_block(test_cache, test_update)
+			if (accept if self.test_interval is None else i % self.test_interval == 0):
+				if self.block_proposals:
+					fx_test = fnn.sigmoid(test_cache[1])
+				[_, pred_test, rmsetest] = self.likelihood_func(fnn, self.testdata, w_proposal if accept else w, tau_pro, inputs=self.test_inputs, fx=fx_test)
+				rmsetest_record = rmsetest
+				if self.save_fx:
+					np.copyto(fxtest_record, pred_test.reshape(fxtest_record.shape))
+			# otherwise carried forward, like the rest of a rejected step
+
+			if accept:
+				if self.langevin:
+					grad_current = grad_proposal
+				if self.block_proposals:
+					fnn.commit_block(train_cache, train_update)
 				naccept  =  naccept + 1
 				likelihood = likelihood_proposal
 				prior_current = prior_prop
-				w = w_proposal
+				np.copyto(w, w_proposal)
 				eta = eta_pro
 				#print (i,'accepted')
-				accept_list.write('{} {} {} {} {} {} {}\n'.format(self.temperature,naccept, i, rmsetrain, rmsetest, likelihood, diff_likelihood + diff_prior))
-				pos_w[i + 1,] = w_proposal
-				pos_tau[i + 1,] = tau_pro
-				fxtrain_samples[i + 1, :] = pred_train
-				fxtest_samples[i + 1, :] = pred_test
-				rmse_train[i + 1,] = rmsetrain
-				rmse_test[i + 1,] = rmsetest
-				plt.plot(x_train, pred_train)
-			else:
-				accept_list.write('{} x {} {} {} {} {}\n'.format(self.temperature, i, rmsetrain, rmsetest, likelihood, diff_likelihood + diff_prior))
-				pos_w[i + 1,] = pos_w[i,]
-				pos_tau[i + 1,] = pos_tau[i,]
-				fxtrain_samples[i + 1, :] = fxtrain_samples[i,]
-				fxtest_samples[i + 1, :] = fxtest_samples[i,]
-				rmse_train[i + 1,] = rmse_train[i,]
-				rmse_test[i + 1,] = rmse_test[i,]
+				np.copyto(w_record, w_proposal)
+				if self.save_fx:
+					np.copyto(fxtrain_record, pred_train.reshape(fxtrain_record.shape))
+				rmsetrain_record = rmsetrain
+			if self.labels is not None:
+				slots[i + 1] = slot
+			accept_list.append((i, accept, rmsetrain, rmsetest, likelihood / self.temperature, log_ratio))
+			if store[i + 1]:
+				pos_w.append(w_record)
+				if self.save_fx:
+					fxtrain_samples.append(fxtrain_record)
+					fxtest_samples.append(fxtest_record)
+				rmse_train[n] = rmsetrain_record
+				rmse_test[n] = rmsetest_record
+				n += 1
 			#print('INITIAL W(PROP) BEFORE SWAP',self.temperature,w_proposal,i,rmsetrain)
 			#print('INITIAL W BEFORE SWAP',self.temperature,i,w)
 			#SWAPPING PREP
 			if (i%self.swap_interval == 0):
-				param = np.concatenate([w, np.asarray([eta]).reshape(1), np.asarray([likelihood]),np.asarray([self.temperature])])
-				self.parameter_queue.put(param)
+				if self.labels is None:
+					state[:w_size] = w
+					state[w_size:] = eta, likelihood, self.temperature
+				else:  # only what the swap test reads
+					state[w_size+1:] = likelihood, self.temperature
 				self.signal_main.set()
 				self.event.wait()
+				self.event.clear()
 				#print(i, self.temperature)
-				# retrieve parameters fom queues if it has been swapped
-				if not self.parameter_queue.empty() :
-					try:
-						result =  self.parameter_queue.get()
-						#print(self.temperature, w, 'param after swap')
-						w= result[0:w.size]
-						eta = result[w.size]
-						likelihood = result[w.size+1]
-					except:
-						print ('error')
-		param = np.concatenate([w, np.asarray([eta]).reshape(1), np.asarray([likelihood]),np.asarray([self.temperature])])
-		#print('SWAPPED PARAM',self.temperature,param)
-		self.parameter_queue.put(param)
+				slot = self.state_row % len(self.temperatures) if self.labels is None else self.labels[self.state_row]
+				temperature = self.temperatures[slot]
+				if self.labels is None and (state[w_size] != eta or not np.array_equal(state[:w_size], w)):
+					# the main process has exchanged the row with a neighbour's, the prior and the records follow the new state
+					w = state[:w_size].astype(self.dtype)
+					eta = state[w_size]
+					likelihood = state[w_size+1]
+					prior_current = self.prior_likelihood(sigma_squared, nu_1, nu_2, w, math.exp(eta))
+					[_, pred_train, rmsetrain_record] = self.likelihood_func(fnn, self.traindata, w, math.exp(eta), inputs=self.train_inputs)
+					[_, pred_test, rmsetest_record] = self.likelihood_func(fnn, self.testdata, w, math.exp(eta), inputs=self.test_inputs)
+					np.copyto(w_record, w)
+					if self.save_fx:
+						np.copyto(fxtrain_record, pred_train.reshape(fxtrain_record.shape))
+						np.copyto(fxtest_record, pred_test.reshape(fxtest_record.shape))
+					if self.subsample is not None:
+						sq_current = np.sum(np.square(y_train - pred_train), axis=1, dtype=np.float64)
+					rows_used[i + 1] += trainsize
+				# else the state is ours, only the temperature it is compared at may move
+				self.temperature = temperature
+				if self.langevin:
+					grad_current = fnn.evaluate_gradient(self.traindata, w, math.exp(eta), self.temperature, sigma_squared, inputs=self.train_inputs)
+				if self.block_proposals:  # also bounds the rounding drift of the incremental updates
+					train_cache = fnn.forward_cache(train_X, w)
+					test_cache = fnn.forward_cache(test_X, w)
+		if progress is not None:
+			progress[:] = samples, naccept, rmsetrain_record
 		make_directory(self.directory+'/results')
-		make_directory(self.directory+'/posterior')
 		print ((naccept*100 / (samples * 1.0)), '% was accepted')
 		accept_ratio = naccept / (samples * 1.0) * 100
 		# plt.title("Plot of Accepted Proposals")
 		# plt.savefig(self.directory+'/results/proposals.png')
 		# plt.clf()
 		#SAVING PARAMETERS
-		file_name = self.directory+'/posterior/pos_w_chain_'+ str(self.temperature)+ '.txt'
-		np.savetxt(file_name,pos_w )
-		# file_name = self.directory+'/posterior/fxtrain_samples_chain_'+ str(self.temperature)+ '.txt'
-		# np.savetxt(file_name, fxtrain_samples, fmt='%.2f')
-		# file_name = self.directory+'/posterior/fxtest_samples_chain_'+ str(self.temperature)+ '.txt'
-		# np.savetxt(file_name, fxtest_samples, fmt='%.2f')
-		file_name = self.directory+'/posterior/rmse_test_chain_'+ str(self.temperature)+ '.txt'
+		accept_list.close()
+		pos_w.close()
+		if self.save_fx:
+			fxtrain_samples.close()
+			fxtest_samples.close()
+		file_name = self.directory+'/posterior/rmse_test_chain_'+ self.tag+ '.txt'
 		np.savetxt(file_name, rmse_test, fmt='%.2f')
-		file_name = self.directory+'/posterior/rmse_train_chain_'+ str(self.temperature)+ '.txt'
+		file_name = self.directory+'/posterior/rmse_train_chain_'+ self.tag+ '.txt'
 		np.savetxt(file_name, rmse_train, fmt='%.2f')
-		file_name = self.directory + '/posterior/accept_list_chain_' + str(self.temperature) + '_accept.txt'
+		file_name = self.directory + '/posterior/accept_list_chain_' + self.tag + '_accept.txt'
 		np.savetxt(file_name, [accept_ratio], fmt='%.2f')
+		file_name = self.directory + '/posterior/rows_used_chain_' + self.tag + '.txt'
+		np.savetxt(file_name, rows_used, fmt='%d')
+		if self.labels is not None:
+			file_name = self.directory + '/posterior/labels_chain_' + self.tag + '.txt'
+			np.savetxt(file_name, slots, fmt='%d')
 
 		self.signal_main.set()
 
 
 # Parallel tempering Bayesian Neural transfer Learning Class
 class ParallelTemperingTL(object):
-	def __init__(self, num_chains, samples, sources, train_data, test_data, target_train_data, target_test_data, topology, directory,  max_temp, swap_interval, type='regression'):
+	def __init__(self, num_chains, samples, sources, train_data, test_data, target_train_data, target_test_data, topology, directory,  max_temp, swap_interval, type='regression', precision='float64', sparse_threshold=0.3, subsample=None, epsilon=0.05, block_proposals=False, langevin=False, test_interval=None, backend='auto', seed=None, save_fx=False, progress_interval=1.0, swap_labels=False, adapt_ladder=False, adaptation_lag=100, adaptation_time=10):
 		# Create file objects to write the attributes of the samples
 		self.directory = directory
 		if not os.path.isdir(self.directory):
 			os.mkdir(self.directory)
 		#Source fnn chain variables
 		self.topology = topology
-		self.train_data = train_data
-		self.test_data = test_data
-		self.target_train_data = target_train_data
-		self.target_test_data = target_test_data
-		self.num_param = (topology[0] * topology[1]) + (topology[1] * topology[2]) + topology[1] + topology[2]
+		self.dtype = np.dtype(precision)  # 'float32' halves memory traffic; likelihoods and MH ratios stay in float64
+		self.train_data = [data.astype(self.dtype, copy=False) for data in train_data]
+		self.test_data = [data.astype(self.dtype, copy=False) for data in test_data]
+		self.target_train_data = target_train_data.astype(self.dtype, copy=False)
+		self.target_test_data = target_test_data.astype(self.dtype, copy=False)
+		#Sparse first layer for input blocks that are mostly one value (density under sparse_threshold, 0 disables it)
+		self.train_inputs = [sparse_inputs(data, topology[0], sparse_threshold) for data in self.train_data]
+		self.test_inputs = [sparse_inputs(data, topology[0], sparse_threshold) for data in self.test_data]
+		self.target_train_inputs = sparse_inputs(self.target_train_data, topology[0], sparse_threshold)
+		self.target_test_inputs = sparse_inputs(self.target_test_data, topology[0], sparse_threshold)
+		self.num_param = num_weights(topology)
 		#TL Variables
 		self.num_sources = sources
 		self.type = type
+		#Subsampled MH: rows per step of the sequential test (None keeps the exact test) and its error tolerance
+		self.subsample = subsample
+		self.epsilon = epsilon
+		#Block-wise proposals with incremental forward passes, written for the single hidden layer Network
+		if block_proposals and len(topology) != 3:
+			raise ValueError('block_proposals needs a [input, hidden, output] topology, got {}'.format(topology))
+		if block_proposals and subsample is not None:
+			raise ValueError('block_proposals and subsample cannot be combined')
+		self.block_proposals = block_proposals
+		#MALA proposals driven by Network.evaluate_gradient, an alternative to the block and subsampled modes
+		if langevin and (block_proposals or subsample is not None):
+			raise ValueError('langevin cannot be combined with block_proposals or subsample')
+		self.langevin = langevin
+		#Test set evaluation: on accepted states (None) or every test_interval iterations, carried forward in between
+		self.test_interval = test_interval
+		#Posterior samples stream to posterior/*.bin (see read_posterior); save_fx adds the train/test outputs of every sample
+		self.save_fx = save_fx
+		#Likelihood and prior kernels, a name from BACKENDS or 'auto'
+		self.backend = make_backend(backend)
+		#RANDOM STREAMS: one SeedSequence drives the coordinator and, spawned, an independent Generator per replica and per task's swaps
+		self.seed_sequence = np.random.SeedSequence(seed)
+		self.rng = np.random.default_rng(self.seed_sequence)
 		# Parallel Tempering Variables
 		self.swap_interval = swap_interval
 		self.max_temp = max_temp
-		# self.num_swap = [0 for index in range(self.num_sources+1)]
-		self.num_swap = 0
-		# self.total_swap_proposals = [0 for index in range(self.num_sources+1)]
-		self.total_swap_proposals = 0
 		self.num_chains = num_chains
+		#Swap counts per task and adjacent pair of its ladder, each task's coordinator thread only touches its own row
+		self.num_swap = np.zeros((self.num_sources + 1, num_chains - 1), dtype=int)
+		self.total_swap_proposals = np.zeros((self.num_sources + 1, num_chains - 1), dtype=int)
+		#ADAPTIVE LADDER: every task's temperatures are shared with its replicas and, with adapt_ladder, tuned during burn-in
+		#from the pair acceptances (see adapt_temperatures). Files keep the names of the initial ladder
+		if adapt_ladder and not np.isfinite(max_temp):
+			raise ValueError('adapt_ladder needs a finite max_temp')
+		self.adapt_ladder = adapt_ladder
+		self.adaptation_lag = adaptation_lag
+		self.adaptation_time = adaptation_time
+		self.ladders = [multiprocessing.RawArray('d', num_chains) for index in range(self.num_sources + 1)]
 		self.source_chains = [list() for index in range(self.num_sources)]
 		self.target_chains = []
 		self.temperatures = []
 		self.num_samples = int(samples/self.num_chains)
 		self.sub_sample_size = max(1, int( 0.05* self.num_samples))
-		# create queues for transfer of parameters between process chain
-		self.source_parameter_queue = [[multiprocessing.Queue() for i in range(num_chains)] for index in range(self.num_sources)]
-		self.target_parameter_queue = [multiprocessing.Queue() for i in range(num_chains)]
-		self.source_chain_queue = [multiprocessing.JoinableQueue() for index in range(self.num_sources)]
-		self.target_chain_queue = multiprocessing.JoinableQueue()
+		#SWAP TABLE: one float64 row [w, eta, untempered likelihood, temperature] per replica in shared memory, indexed [task, chain] with
+		#the target task last. Replicas write their row in place and the main process swaps rows, the events only signal
+		self.state = shared_memory.SharedMemory(create=True, size=(self.num_sources + 1) * num_chains * (self.num_param + 3) * 8)
+		self.state_table = np.ndarray((self.num_sources + 1, num_chains, self.num_param + 3), dtype=np.float64, buffer=self.state.buf)
+		#swap_labels: replicas keep their states and an accepted swap exchanges two entries of a shared permutation, the ladder
+		#slot of every [task, chain]. Per-temperature files are put back together from the replicas' files after the run
+		self.swap_labels = swap_labels
+		self.labels = multiprocessing.RawArray('i', (self.num_sources + 1) * num_chains)
+		self.label_table = np.ctypeslib.as_array(self.labels).reshape(self.num_sources + 1, num_chains)
 		self.source_wait_chain = [[multiprocessing.Event() for i in range (self.num_chains)] for index in range(self.num_sources)]
 		self.target_wait_chain = [multiprocessing.Event() for i in range (self.num_chains)]
 		self.source_event = [[multiprocessing.Event() for i in range (self.num_chains)] for index in range(self.num_sources)]
 		self.target_event = [multiprocessing.Event() for i in range (self.num_chains)]
+		#PROGRESS: replicas write [samples done, accepted, train rmse] to shared memory, a reporter thread prints it
+		#every progress_interval seconds (None for no reports)
+		self.progress_interval = progress_interval
+		self.source_progress = [[multiprocessing.RawArray('d', 3) for i in range(self.num_chains)] for index in range(self.num_sources)]
+		self.target_progress = [multiprocessing.RawArray('d', 3) for i in range(self.num_chains)]
 
-		self.wsize = (topology[0] * topology[1]) + (topology[1] * topology[2]) + topology[1] + topology[2]
+		self.wsize = num_weights(topology)
 		self.targetTop = self.topology[:]
-		self.wsize_target = (self.targetTop[0] * self.targetTop[1]) + (self.targetTop[1] * self.targetTop[2]) + self.targetTop[1] + self.targetTop[2]
+		self.wsize_target = num_weights(self.targetTop)
 
 	@staticmethod
 	def default_beta_ladder(ndim, ntemps, Tmax): #https://github.com/konqr/ptemcee/blob/master/ptemcee/sampler.py
@@ -494,53 +1107,179 @@ class ParallelTemperingTL(object):
 		# 	temp += 2.5 #(self.max_temp/self.num_chains)
 		# 	print (self.temperatures[i])
 		#Geometric Spacing
-		betas = self.default_beta_ladder(2, ntemps=self.num_chains, Tmax=self.max_temp)
+		betas = self.default_beta_ladder(int(self.num_param), ntemps=self.num_chains, Tmax=self.max_temp)
 		self.temperatures = [np.inf if beta == 0 else 1.0/beta for beta in betas]
+		for ladder in self.ladders:
+			ladder[:] = self.temperatures
 
 
-	def initialize_chains(self, burn_in):
+	def initialize_chains(self, burn_in, thin=1, keep_burn_in=True):
 		self.burn_in = burn_in
+		#Stored samples: every thin-th from burn-in on, plus the burn-in rows on the same grid when keep_burn_in
+		self.thin = thin
+		self.keep_burn_in = keep_burn_in
 		self.assign_temperatures()
-		w = np.random.randn(self.num_param)
+		self.label_table[:] = np.arange(self.num_chains)
+		labels = self.labels if self.swap_labels else None
+		w = self.rng.standard_normal(self.num_param).astype(self.dtype)
+		replica_rng = [np.random.default_rng(child) for child in self.seed_sequence.spawn((self.num_sources + 1) * self.num_chains)]
+		self.swap_rng = [np.random.default_rng(child) for child in self.seed_sequence.spawn(self.num_sources + 1)]
 
 		for s_index in range(self.num_sources):
 			name = 'source_'+str(s_index)
 			make_directory(self.directory+'/source_'+str(s_index))
 			for c_index in range(0, self.num_chains):
-				self.source_chains[s_index].append(ptReplica(name, w, self.num_samples, self.train_data[s_index], self.test_data[s_index], self.topology, self.burn_in, self.temperatures[c_index], self.swap_interval, self.directory+'/source_'+str(s_index), self.source_parameter_queue[s_index][c_index], self.source_wait_chain[s_index][c_index], self.source_event[s_index][c_index]))
+				self.source_chains[s_index].append(ptReplica(name, w, self.num_samples, self.train_data[s_index], self.test_data[s_index], self.topology, self.burn_in, self.temperatures[c_index], self.swap_interval, self.directory+'/source_'+str(s_index), self.state, self.source_wait_chain[s_index][c_index], self.source_event[s_index][c_index], dtype=self.dtype, train_inputs=self.train_inputs[s_index], test_inputs=self.test_inputs[s_index], subsample=self.subsample, epsilon=self.epsilon, block_proposals=self.block_proposals, langevin=self.langevin, test_interval=self.test_interval, backend=self.backend, rng=replica_rng[s_index * self.num_chains + c_index], save_fx=self.save_fx, thin=self.thin, keep_burn_in=self.keep_burn_in, progress=self.source_progress[s_index][c_index], state_row=s_index * self.num_chains + c_index, labels=labels, temperatures=self.ladders[s_index]))
 		name = 'target'
 		make_directory(self.directory+'/target')
 		for c_index in range(0, self.num_chains):
-			self.target_chains.append(ptReplica(name, w, self.num_samples, self.target_train_data, self.target_test_data, self.topology, self.burn_in, self.temperatures[c_index], self.swap_interval, self.directory+'/target', self.target_parameter_queue[c_index], self.target_wait_chain[c_index], self.target_event[c_index]))
-
-	def swap_procedure(self, parameter_queue_1, parameter_queue_2):
-		if parameter_queue_2.empty() is False and parameter_queue_1.empty() is False:
-			param1 = parameter_queue_1.get()
-			param2 = parameter_queue_2.get()
-			w1 = param1[0:self.num_param]
-			eta1 = param1[self.num_param]
-			lhood1 = param1[self.num_param+1]
-			T1 = param1[self.num_param+2]
-			w2 = param2[0:self.num_param]
-			eta2 = param2[self.num_param]
-			lhood2 = param2[self.num_param+1]
-			T2 = param2[self.num_param+2]
-			#SWAPPING PROBABILITIES
-			try:
-				swap_proposal =  min(1,0.5*np.exp(min(709,lhood2 - lhood1)))
-			except OverflowError:
-				swap_proposal = 1
-			u = np.random.uniform(0,1)
-			if u < swap_proposal:
-				self.total_swap_proposals += 1
-				self.num_swap += 1
-				param_temp =  param1
-				param1 = param2
-				param2 = param_temp
-			return param1, param2
-		else:
-			self.total_swap_proposals += 1
-			return
+			self.target_chains.append(ptReplica(name, w, self.num_samples, self.target_train_data, self.target_test_data, self.topology, self.burn_in, self.temperatures[c_index], self.swap_interval, self.directory+'/target', self.state, self.target_wait_chain[c_index], self.target_event[c_index], dtype=self.dtype, train_inputs=self.target_train_inputs, test_inputs=self.target_test_inputs, subsample=self.subsample, epsilon=self.epsilon, block_proposals=self.block_proposals, langevin=self.langevin, test_interval=self.test_interval, backend=self.backend, rng=replica_rng[self.num_sources * self.num_chains + c_index], save_fx=self.save_fx, thin=self.thin, keep_burn_in=self.keep_burn_in, progress=self.target_progress[c_index], state_row=self.num_sources * self.num_chains + c_index, labels=labels, temperatures=self.ladders[self.num_sources]))
+
+	def print_progress(self):
+		#One line per task: samples done by its slowest chain, acceptance over all its chains, train rmse of the T=1 chain
+		tasks = [('source_'+str(index), self.source_progress[index]) for index in range(self.num_sources)] + [('target', self.target_progress)]
+		for task, (name, arrays) in enumerate(tasks):
+			progress = np.array([np.frombuffer(array) for array in arrays])
+			cold = np.argmin(self.label_table[task]) if self.swap_labels else 0
+			print('{} samples: {:.0f}/{} accepted: {:.1f}% train rmse (T=1): {:.4f}'.format(name, progress[:, 0].min(), self.num_samples, 100 * progress[:, 1].sum() / max(1, progress[:, 0].sum()), progress[cold, 2]))
+		sys.stdout.flush()
+
+	def report_progress(self, stop):
+		while not stop.wait(self.progress_interval):
+			self.print_progress()
+
+	def plot_diagnostics(self, source_rmse_train, source_rmse_test, file_name='figure.png'):
+		#Post-hoc plot of the retained train/test rmse of the first source task, all chains end to end
+		import matplotlib.pyplot as plt
+		source_rmse_tr = source_rmse_train[0].reshape(-1)
+		source_rmse_tes = source_rmse_test[0].reshape(-1)
+		fig = plt.figure()
+		plt.plot(np.linspace(0,1,source_rmse_tr.shape[0]), source_rmse_tr, label='train')
+		plt.plot(np.linspace(0,1,source_rmse_tes.shape[0]), source_rmse_tes, label='test')
+		plt.savefig(file_name)
+		plt.close(fig)
+
+	def swap_procedure(self, task, pair, state_1, state_2):
+		# rows of the swap table, both chains have written theirs before signalling
+		# tempered here by the row's own temperature, so T = inf compares as 0 rather than 0*inf
+		lhood1 = state_1[self.num_param+1] / state_1[self.num_param+2]
+		lhood2 = state_2[self.num_param+1] / state_2[self.num_param+2]
+		#SWAPPING PROBABILITIES
+		try:
+			swap_proposal =  min(1,0.5*np.exp(min(709,lhood2 - lhood1)))
+		except OverflowError:
+			swap_proposal = 1
+		u = self.swap_rng[task].uniform(0,1)
+		self.total_swap_proposals[task, pair] += 1
+		swapped = u < swap_proposal
+		if swapped:
+			self.num_swap[task, pair] += 1
+			if not self.swap_labels:
+				state_1[:], state_2[:] = state_2.copy(), state_1.copy()
+		return swapped
+
+	def swap_neighbours(self, task):
+		#Adjacent pairs of one task's ladder, coldest first; the chain moved up by a swap meets the next one in the same round.
+		#Returns which pairs swapped
+		accepted = np.zeros(self.num_chains-1, dtype=bool)
+		if not self.swap_labels:
+			for k in range(0,self.num_chains-1):
+				accepted[k] = self.swap_procedure(task, k, self.state_table[task, k], self.state_table[task, k+1])
+			return accepted
+		labels = self.label_table[task]
+		owner = np.argsort(labels)  # chain at every ladder slot
+		for k in range(0,self.num_chains-1):
+			accepted[k] = self.swap_procedure(task, k, self.state_table[task, owner[k]], self.state_table[task, owner[k+1]])
+			if accepted[k]:
+				labels[owner[k]], labels[owner[k+1]] = k+1, k
+				owner[k], owner[k+1] = owner[k+1], owner[k]
+		return accepted
+
+	def adapt_temperatures(self, task, accepted, swap_round):
+		#Vousden et al. (arXiv:1501.05823) style: the gaps between neighbouring temperatures widen where a round's swaps
+		#were accepted more than average and narrow where less, which drives the pairs toward equal acceptance. T=1 and the
+		#hottest temperature stay put and the steps decay as adaptation_lag / (adaptation_lag + round) / adaptation_time
+		ladder = np.ctypeslib.as_array(self.ladders[task])
+		kappa = self.adaptation_lag / float(self.adaptation_lag + swap_round) / self.adaptation_time
+		gaps = np.diff(ladder)
+		#a narrowing gap loses less than its width, and the widening ones share exactly what the narrowing ones give up,
+		#so the span is unchanged and no gap moves against its acceptance
+		step = gaps * np.expm1(kappa * (accepted - np.mean(accepted)))
+		grow = np.sum(step[step > 0])
+		if grow > 0:
+			step[step > 0] *= -np.sum(step[step < 0]) / grow
+			ladder[1:-1] = ladder[0] + np.cumsum(gaps + step)[:-1]
+
+	def wait_for_replica(self, chain, signal, timeout=1.0):
+		#Wait for a replica to reach its swap point, checking every timeout seconds that it is still alive.
+		#False once any replica of the run has died, so no coordinator waits on a chain that cannot arrive
+		while not signal.wait(timeout):
+			if chain.exitcode is not None:
+				self.failed.set()
+			if self.failed.is_set():
+				return False
+		return not self.failed.is_set()
+
+	def coordinate_swaps(self, task, chains, wait_chain, event):
+		#Swap rounds of one task, run in a thread of its own so no ladder waits on another task's chains. Every replica stops
+		#at the same iterations, so the rounds are counted rather than polled: wait for all chains, swap, release each one
+		burnin = int(self.num_samples*self.burn_in)
+		try:
+			for swap_round, iteration in enumerate(range(0, self.num_samples - 1, self.swap_interval)):
+				for k in range(0,self.num_chains):
+					if not self.wait_for_replica(chains[k], wait_chain[k]):
+						return
+					wait_chain[k].clear()
+				accepted = self.swap_neighbours(task)
+				if self.adapt_ladder and iteration < burnin:
+					self.adapt_temperatures(task, accepted, swap_round)
+				for k in range (self.num_chains):
+					event[k].set()
+		except Exception:
+			self.failed.set()  # run_chains stops the replicas, which would otherwise wait on this task forever
+			raise
+
+	def relabel_chains(self, directory):
+		#swap_labels runs: rewrite the replica_<c> files of one task as the usual per-temperature ones,
+		#row j at temperature k taken from the replica that held ladder slot k on row j
+		posterior = directory + '/posterior/'
+		tags = ['replica_' + str(c_index) for c_index in range(self.num_chains)]
+		slots = np.array([np.loadtxt(posterior + 'labels_chain_' + tag + '.txt', dtype=int, ndmin=1) for tag in tags])
+		owner = np.argsort(slots, axis=0)
+		steps = np.arange(self.num_samples)
+		stored = np.flatnonzero(stored_rows(self.num_samples, self.burn_in, self.thin, self.keep_burn_in))
+		names = ['pos_w_chain_'] + (['fxtrain_samples_chain_', 'fxtest_samples_chain_'] if self.save_fx else [])
+		for name in names:
+			chains = [read_posterior(posterior + name + tag + '.bin') for tag in tags]
+			for k, temperature in enumerate(self.temperatures):
+				header = dict(chains[0][1], temperature=temperature)
+				writer = SampleWriter(posterior + name + str(temperature) + '.bin', header['row_shape'], np.lib.format.descr_to_dtype(header['dtype']), header)
+				for row, c_index in enumerate(owner[k, stored]):
+					writer.append(chains[c_index][0][row])
+				writer.close()
+		#one accept-log record per iteration from the second row on
+		records = [read_posterior(directory + '/acceptlist_' + tag + '.bin') for tag in tags]
+		log = np.array([chain for chain, header in records])
+		for name, fmt in (('rmse_test_chain_', '%.2f'), ('rmse_train_chain_', '%.2f')):
+			rmse = np.array([np.loadtxt(posterior + name + tag + '.txt', ndmin=1) for tag in tags])
+			for k, temperature in enumerate(self.temperatures):
+				np.savetxt(posterior + name + str(temperature) + '.txt', rmse[owner[k, stored], np.arange(stored.size)], fmt=fmt)
+		rows_used = np.array([np.loadtxt(posterior + 'rows_used_chain_' + tag + '.txt', dtype=int, ndmin=1) for tag in tags])
+		for k, temperature in enumerate(self.temperatures):
+			accepted = log[owner[k, 1:], steps[:-1]]
+			writer = SampleWriter(directory + '/acceptlist_' + str(temperature) + '.bin', (), ACCEPT_RECORD, dict(records[0][1], temperature=temperature))
+			for record in accepted:
+				writer.append(record)
+			writer.close()
+			np.savetxt(posterior + 'accept_list_chain_' + str(temperature) + '_accept.txt', [np.sum(accepted['accepted']) * 100 / (self.num_samples * 1.0)], fmt='%.2f')
+			np.savetxt(posterior + 'rows_used_chain_' + str(temperature) + '.txt', rows_used[owner[k], steps], fmt='%d')
+		for tag in tags:
+			for name in names:
+				os.remove(posterior + name + tag + '.bin')
+			for name in ('rmse_test_chain_', 'rmse_train_chain_', 'rows_used_chain_', 'labels_chain_'):
+				os.remove(posterior + name + tag + '.txt')
+			os.remove(posterior + 'accept_list_chain_' + tag + '_accept.txt')
+			os.remove(directory + '/acceptlist_' + tag + '.bin')
 
 	def run_chains(self):
 		# x_test = np.linspace(0,1,num=self.testdata.shape[0])
@@ -574,125 +1313,94 @@ class ParallelTemperingTL(object):
 		for j in range(self.num_chains):
 			self.target_chains[j].start()
 
-		#SWAP PROCEDURE
-		#chain_num = 0
-		while True:
-			for index in range(self.num_sources):
-				for k in range(0,self.num_chains):
-					self.source_wait_chain[index][k].wait()
-
-				for k in range(0,self.num_chains-1):
-					#print('starting swap')
-					self.source_chain_queue[index].put(self.swap_procedure(self.source_parameter_queue[index][k], self.source_parameter_queue[index][k+1]))
-
-					while True:
-						if self.source_chain_queue[index].empty():
-							self.source_chain_queue[index].task_done()
-							#print(k,'EMPTY QUEUE')
-							break
-						swap_process = self.source_chain_queue[index].get()
-						#print(swap_process)
-						if swap_process is None:
-							self.source_chain_queue[index].task_done()
-							#print(k,'No Process')
-							break
-						param1, param2 = swap_process
-
-						self.source_parameter_queue[index][k].put(param1)
-						self.source_parameter_queue[index][k+1].put(param2)
-
-				for k in range (self.num_chains):
-						self.source_event[index][k].set()
-
-			for k in range(0,self.num_chains):
-				self.target_wait_chain[k].wait()
-
-			for k in range(0,self.num_chains-1):
-				#print('starting swap')
-				self.target_chain_queue.put(self.swap_procedure(self.target_parameter_queue[k], self.target_parameter_queue[k+1]))
-
-				while True:
-					if self.target_chain_queue.empty():
-						self.target_chain_queue.task_done()
-						#print(k,'EMPTY QUEUE')
-						break
-					swap_process = self.target_chain_queue.get()
-					#print(swap_process)
-					if swap_process is None:
-						self.target_chain_queue.task_done()
-						#print(k,'No Process')
-						break
-					param1, param2 = swap_process
-
-					self.target_parameter_queue[k].put(param1)
-					self.target_parameter_queue[k+1].put(param2)
-			for k in range (self.num_chains):
-					self.target_event[k].set()
-
-			count = 0
-			for index in range(self.num_sources):
-				for i in range(self.num_chains):
-					if self.source_chains[index][i].is_alive() is False:
-						count += 1
-			for i in range(self.num_chains):
-				if self.target_chains[i].is_alive() is False:
-					count += 1
-			if count == (self.num_sources + 1)*self.num_chains :
-				#print(count)
-				break
+		if self.progress_interval is not None:
+			stop_reporter = threading.Event()
+			reporter = threading.Thread(target=self.report_progress, args=(stop_reporter,))
+			reporter.daemon = True
+			reporter.start()
 
+		#SWAP PROCEDURE
+		#One coordinator per task, each with its own swap stream, so seeded runs stay repeatable without a global barrier
+		self.failed = threading.Event()  # set when a replica dies or a coordinator fails
+		coordinators = [threading.Thread(target=self.coordinate_swaps, args=(index, self.source_chains[index], self.source_wait_chain[index], self.source_event[index])) for index in range(self.num_sources)]
+		coordinators.append(threading.Thread(target=self.coordinate_swaps, args=(self.num_sources, self.target_chains, self.target_wait_chain, self.target_event)))
+		for coordinator in coordinators:
+			coordinator.daemon = True
+			coordinator.start()
+		for coordinator in coordinators:
+			coordinator.join()
+
+		chains = [chain for task in self.source_chains for chain in task] + self.target_chains
+		stopped = []
+		if self.failed.is_set():
+			#release every replica still waiting at a swap point and stop the rest, their results are incomplete anyway
+			for event in [event for task in self.source_event for event in task] + self.target_event:
+				event.set()
+			stopped = [chain for chain in chains if chain.is_alive()]
+			for chain in stopped:
+				chain.terminate()
 		#JOIN THEM TO MAIN PROCESS
-		for index in range(self.num_sources):
-			for j in range(0,self.num_chains):
-				self.source_chains[index][j].join()
-		for j in range(self.num_chains):
-			self.target_chains[j].join()
-		for index in range(self.num_sources):
-			self.source_chain_queue[index].join()
-		self.target_chain_queue.join()
+		for chain in chains:
+			chain.join()
+		#Release the swap table, the view has to go before the block can be closed
+		self.state_table = None
+		self.state.close()
+		self.state.unlink()
+		if self.progress_interval is not None:
+			stop_reporter.set()
+			reporter.join()
+			self.print_progress()
+		#a replica can also die after its last swap point, when no coordinator is waiting on it any more
+		dead = ['{} T={} (exit code {})'.format(os.path.basename(chain.directory), chain.temperature, chain.exitcode) for chain in chains if chain.exitcode != 0 and chain not in stopped]
+		if self.failed.is_set() or dead:
+			raise RuntimeError('replica failed, run stopped: ' + (', '.join(dead) or 'swap coordinator error'))
+		if self.swap_labels:
+			for index in range(self.num_sources):
+				self.relabel_chains(self.directory+'/source_'+str(index))
+			self.relabel_chains(self.directory+'/target')
 
 		#GETTING DATA
 		burnin = int(self.num_samples*self.burn_in)
-		source_pos_w = np.zeros((self.num_sources, self.num_chains,self.num_samples - burnin, self.num_param))
-		target_pos_w = np.zeros((self.num_chains, self.num_samples - burnin, self.num_param))
+		retained = len(range(burnin, self.num_samples, self.thin))  # the post burn-in rows are the last ones of every file
+		#pos_w stays on disk: one read-only memmap per chain, indexed [s_index][c_index] and [c_index]
+		source_pos_w = [[None] * self.num_chains for s_index in range(self.num_sources)]
+		target_pos_w = [None] * self.num_chains
 		# fxtrain_samples = np.zeros((self.num_chains,self.num_samples - burnin, self.train_data.shape[0]))
-		source_rmse_train = np.zeros((self.num_sources, self.num_chains, self.num_samples - burnin))
-		target_rmse_train = np.zeros((self.num_chains, self.num_samples - burnin))
-		source_rmse_test = np.zeros((self.num_sources, self.num_chains, self.num_samples - burnin))
-		target_rmse_test = np.zeros((self.num_chains, self.num_samples - burnin))
+		source_rmse_train = np.zeros((self.num_sources, self.num_chains, retained))
+		target_rmse_train = np.zeros((self.num_chains, retained))
+		source_rmse_test = np.zeros((self.num_sources, self.num_chains, retained))
+		target_rmse_test = np.zeros((self.num_chains, retained))
 		source_accept_ratio = np.zeros((self.num_sources, self.num_chains, 1))
 		target_accept_ratio = np.zeros((self.num_chains, 1))
 
 		for s_index in range(self.num_sources):
 			for c_index in range(self.num_chains):
-				file_name = self.directory+'/source_'+str(s_index)+'/posterior/pos_w_chain_'+ str(self.temperatures[c_index])+ '.txt'
-				dat = np.loadtxt(file_name)
-				source_pos_w[s_index, c_index, :, :] = dat[burnin:,:]
+				file_name = self.directory+'/source_'+str(s_index)+'/posterior/pos_w_chain_'+ str(self.temperatures[c_index])+ '.bin'
+				source_pos_w[s_index][c_index] = read_posterior(file_name)[0][-retained:]
 
 				file_name = self.directory+'/source_'+str(s_index)+'/posterior/rmse_test_chain_'+ str(self.temperatures[c_index])+ '.txt'
 				dat = np.loadtxt(file_name)
-				source_rmse_test[s_index, c_index, :] = dat[burnin:]
+				source_rmse_test[s_index, c_index, :] = dat[-retained:]
 
 				file_name = self.directory+'/source_'+str(s_index)+'/posterior/rmse_train_chain_'+ str(self.temperatures[c_index])+ '.txt'
 				dat = np.loadtxt(file_name)
-				source_rmse_train[s_index, c_index, :] = dat[burnin:]
+				source_rmse_train[s_index, c_index, :] = dat[-retained:]
 
 				file_name = self.directory+'/source_'+str(s_index)+ '/posterior/accept_list_chain_' + str(self.temperatures[c_index]) + '_accept.txt'
 				dat = np.loadtxt(file_name)
 				source_accept_ratio[s_index, c_index, :] = dat
 
 		for c_index in range(self.num_chains):
-			file_name = self.directory+'/target'+'/posterior/pos_w_chain_'+ str(self.temperatures[c_index])+ '.txt'
-			dat = np.loadtxt(file_name)
-			target_pos_w[c_index, :, :] = dat[burnin:,:]
+			file_name = self.directory+'/target'+'/posterior/pos_w_chain_'+ str(self.temperatures[c_index])+ '.bin'
+			target_pos_w[c_index] = read_posterior(file_name)[0][-retained:]
 
 			file_name = self.directory+'/target'+'/posterior/rmse_test_chain_'+ str(self.temperatures[c_index])+ '.txt'
 			dat = np.loadtxt(file_name)
-			target_rmse_test[c_index, :] = dat[burnin:]
+			target_rmse_test[c_index, :] = dat[-retained:]
 
 			file_name = self.directory+'/target'+'/posterior/rmse_train_chain_'+ str(self.temperatures[c_index])+ '.txt'
 			dat = np.loadtxt(file_name)
-			target_rmse_train[c_index, :] = dat[burnin:]
+			target_rmse_train[c_index, :] = dat[-retained:]
 
 			file_name = self.directory+'/target'+ '/posterior/accept_list_chain_' + str(self.temperatures[c_index]) + '_accept.txt'
 			dat = np.loadtxt(file_name)
@@ -703,24 +1411,29 @@ class ParallelTemperingTL(object):
 		# pos_w = pos_w.transpose(2,0,1).reshape(self.num_param,-1)
 		# accept_total = np.sum(accept_ratio)/self.num_chains
 		# fx_train = fxtrain_samples.reshape(self.num_chains*(self.NumSamples - burnin), self.traindata.shape[0])
-		source_rmse_tr = source_rmse_train[0].reshape(self.num_chains*(self.num_samples - burnin), )
-		source_rmse_tes = source_rmse_test[0].reshape(self.num_chains*(self.num_samples - burnin), )
-		plt.plot(np.linspace(0,1,source_rmse_tr.shape[0]), source_rmse_tr, label='train')
-		plt.plot(np.linspace(0,1,source_rmse_tes.shape[0]), source_rmse_tes, label='test')
-		plt.savefig('figure.png')
 		# fx_test = fxtest_samples.reshape(self.num_chains*(self.NumSamples - burnin), self.testdata.shape[0])
 		# rmse_test = rmse_test.reshape(self.num_chains*(self.NumSamples - burnin), 1)
 		# for s in range(self.num_param):
 		# 	self.plot_figure(pos_w[s,:], 'pos_distri_'+str(s))
-		print("NUMBER OF SWAPS =", self.num_swap)
-		print("SWAP ACCEPTANCE = ", self.num_swap*100/self.total_swap_proposals," %")
+		print("NUMBER OF SWAPS =", self.num_swap.sum())
+		print("SWAP ACCEPTANCE = ", self.num_swap.sum()*100/max(1, self.total_swap_proposals.sum())," %")
+		#Per adjacent pair, coldest first, next to the ladder each task ended with
+		for index, name in enumerate(['source_'+str(s_index) for s_index in range(self.num_sources)] + ['target']):
+			pair_acceptance = self.num_swap[index]*100/np.maximum(1, self.total_swap_proposals[index])
+			print(name, "PAIR SWAP ACCEPTANCE =", np.round(pair_acceptance, 1), "% LADDER =", np.round(self.ladders[index], 3))
+			np.savetxt(self.directory+'/'+name+'/swap_acceptance.txt', np.column_stack([self.ladders[index][:-1], self.ladders[index][1:], pair_acceptance]), fmt='%.4f')
 		# return (pos_w, fx_train, fx_test, x_train, x_test, rmse_train, rmse_test, accept_total)
+		return (source_pos_w, target_pos_w, source_rmse_train, source_rmse_test, target_rmse_train, target_rmse_test, source_accept_ratio, target_accept_ratio)
 
 
 
 def make_directory (directory):
-	if not os.path.exists(directory):
+	#replicas of one task create the same directories concurrently
+	try:
 		os.makedirs(directory)
+	except OSError:
+		if not os.path.isdir(directory):
+			raise
 
 def main():
 	#################################
@@ -746,6 +1459,7 @@ def main():
 	swap_ratio = 0.125
 	num_chains = 10
 	burn_in = 0.2
+	seed = None  # an int makes the run reproducible
 
 	#################################
 
@@ -771,16 +1485,16 @@ def main():
 		pass
 
 	#################################
-	random.seed(time.time())
 	swap_interval =  int(swap_ratio * (num_samples[problem]/num_chains)) #how ofen you swap neighbours
 	timer = time.time()
 	path = "RESULTS/" + problem_name + "_results_" + str(num_samples[problem]) + "_" + str(max_temp) + "_" + str(num_chains) + "_" + str(swap_ratio)
 	make_directory(path)
 	print(path)
-	pt = ParallelTemperingTL(num_chains, num_samples[problem], num_sources[problem], train_data, test_data, target_train_data, target_test_data, topology, path,  max_temp, swap_interval, type=problemtype)
+	pt = ParallelTemperingTL(num_chains, num_samples[problem], num_sources[problem], train_data, test_data, target_train_data, target_test_data, topology, path,  max_temp, swap_interval, type=problemtype, seed=seed)
 	pt.initialize_chains(burn_in)
 
-	pt.run_chains()
+	source_pos_w, target_pos_w, source_rmse_train, source_rmse_test, target_rmse_train, target_rmse_test, source_accept_ratio, target_accept_ratio = pt.run_chains()
+	pt.plot_diagnostics(source_rmse_train, source_rmse_test)
 	#
 	# print ('Successfully Regressed')
 	# print (accept_total, '% total accepted')
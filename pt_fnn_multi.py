@@ -6,7 +6,6 @@ import os
 import sys
 import gc
 import numpy as np
-import random
 import time
 import operator
 import math
@@ -24,22 +23,37 @@ from scipy.stats import norm
 
 class Network:
 
-	def __init__(self, Topo, Train, Test, learn_rate):
+	def __init__(self, Topo, Train, Test, learn_rate, dtype=np.float64, rng=None):
 		self.Top = Topo  # NN topology [input, hidden, output]
 		self.TrainData = Train
 		self.TestData = Test
 		self.lrate = learn_rate
+		self.rng = np.random.default_rng() if rng is None else rng  # the owning replica's Generator
 
-		self.W1 = np.random.randn(self.Top[0], self.Top[1]) / np.sqrt(self.Top[0])
-		self.B1 = np.random.randn(1, self.Top[1]) / np.sqrt(self.Top[1])  # bias first layer
-		self.W2 = np.random.randn(self.Top[1], self.Top[2]) / np.sqrt(self.Top[1])
-		self.B2 = np.random.randn(1, self.Top[2]) / np.sqrt(self.Top[1])  # bias second layer
+		#One contiguous parameter buffer in the flat w layout [W1, W2, B1, B2]; the layer matrices are permanent views into it
+		w_layer1size = self.Top[0] * self.Top[1]
+		w_layer2size = self.Top[1] * self.Top[2]
+		b_start = w_layer1size + w_layer2size
+		self.w = np.zeros(b_start + self.Top[1] + self.Top[2], dtype=dtype)
+		self.W1 = self.w[0:w_layer1size].reshape(self.Top[0], self.Top[1])
+		self.W2 = self.w[w_layer1size:b_start].reshape(self.Top[1], self.Top[2])
+		self.B1 = self.w[b_start:b_start + self.Top[1]]  # bias first layer
+		self.B2 = self.w[b_start + self.Top[1]:]  # bias second layer
+
+		self.W1[:] = self.rng.standard_normal((self.Top[0], self.Top[1])) / np.sqrt(self.Top[0])
+		self.B1[:] = self.rng.standard_normal(self.Top[1]) / np.sqrt(self.Top[1])
+		self.W2[:] = self.rng.standard_normal((self.Top[1], self.Top[2])) / np.sqrt(self.Top[1])
+		self.B2[:] = self.rng.standard_normal(self.Top[2]) / np.sqrt(self.Top[1])
 
 		self.hidout = np.zeros((1, self.Top[1]))  # output of first hidden layer
 		self.out = np.zeros((1, self.Top[2]))  # output last layer
 
-	def sigmoid(self, x):
-		return 1 / (1 + np.exp(-x))
+	@staticmethod
+	def sigmoid(x):
+		# stable logistic in the working dtype of x: exp only sees -|x|, so it never overflows
+		e = np.exp(-np.abs(x))
+		r = 1 / (1 + e)
+		return np.where(x >= 0, r, e * r)
 
 	def sampleEr(self, actualout):
 		error = np.subtract(self.out, actualout)
@@ -76,23 +90,20 @@ class Network:
 		# 	self.B1[y] += -1 * self.lrate * hid_delta[y]
 
 	def decode(self, w):
-		w_layer1size = self.Top[0] * self.Top[1]
-		w_layer2size = self.Top[1] * self.Top[2]
-
-		w_layer1 = w[0:w_layer1size]
-		self.W1 = np.reshape(w_layer1, (self.Top[0], self.Top[1]))
-
-		w_layer2 = w[w_layer1size:w_layer1size + w_layer2size]
-		self.W2 = np.reshape(w_layer2, (self.Top[1], self.Top[2]))
-		self.B1 = w[w_layer1size + w_layer2size:w_layer1size + w_layer2size + self.Top[1]]
-		self.B2 = w[w_layer1size + w_layer2size + self.Top[1]:w_layer1size + w_layer2size + self.Top[1] + self.Top[2]]
-
+		# copy w into the parameter buffer, the W1, W2, B1, B2 views pick it up without reslicing
+		if w is not self.w:
+			np.copyto(self.w, w)
 
 	def encode(self):
-		w1 = self.W1.ravel()
-		w2 = self.W2.ravel()
-		w = np.concatenate([w1, w2, self.B1, self.B2])
-		return w
+		# the buffer itself, not a copy: callers that keep it across decode() calls must copy it
+		return self.w
+
+	def propose(self, w, step):
+		# random-walk proposal w + N(0, step) written straight into the parameter buffer, no per-call allocation
+		self.rng.standard_normal(out=self.w, dtype=self.w.dtype)
+		self.w *= step
+		self.w += w
+		return self.w
 
 	def langevin_gradient(self, data, w, depth):  # BP with SGD (Stocastic BP)
 
@@ -111,18 +122,33 @@ class Network:
 				self.ForwardPass(Input)
 				self.BackwardPass(Input, Desired)
 
-		w_updated = self.encode()
+		w_updated = self.encode().copy()  # detach from the parameter buffer
 
 		return  w_updated
 
-	def evaluate_proposal(self, data, w ):  # BP with SGD (Stocastic BP)
+	def evaluate_gradient(self, data, w, tau_sq, temperature, sigma_squared):
+		# full-batch gradient in w of the tempered log-posterior loglik/temperature + log prior, one vectorized backward pass
+		self.decode(w)
+		X = data[:, 0:self.Top[0]]
+		self.ForwardPass(X)  # leaves fx in self.out
+		out_delta = (data[:, self.Top[0]:self.Top[0] + self.Top[2]] - self.out) * (self.out * (1 - self.out)) / (tau_sq * temperature)
+		hid_delta = out_delta.dot(self.W2.T) * (self.hidout * (1 - self.hidout))
+		grad = np.concatenate([X.T.dot(hid_delta).ravel(), self.hidout.T.dot(out_delta).ravel(), -hid_delta.sum(axis=0), -out_delta.sum(axis=0)])
+		return grad - w / sigma_squared
+
+	def evaluate_proposal(self, data, w, batch=True):  # BP with SGD (Stocastic BP)
 
 		self.decode(w)  # method to decode w into W1, W2, B1, B2.
 		size = data.shape[0]
 
 		Input = np.zeros((1, self.Top[0]))  # temp hold input
 		Desired = np.zeros((1, self.Top[2]))
-		fx = np.zeros(size)
+		fx = np.zeros(size, dtype=self.w.dtype)
+
+		if batch:  # one matrix-matrix pass over the whole data block
+			self.ForwardPass(data[:, 0:self.Top[0]])
+			fx[:] = self.out.reshape(size)
+			return fx
 
 		for i in range(0, size):  # to see what fx is produced by your current weight update
 			Input = data[i, 0:self.Top[0]]
@@ -131,9 +157,82 @@ class Network:
 
 		return fx
 
+class PredictiveSummary:
+	#Running mean/variance (Welford) and a fixed-bin histogram of the predictions for each data row, mergeable across
+	#chains. Outputs are sigmoid activations, so the histogram spans [0, 1] and quantiles are good to about 1/bins.
+	#Up to bins samples the raw predictions are kept instead (exact quantiles), so a summary never takes more memory
+	#than the dense (samples, rows) array of the same predictions
+	def __init__(self, rows, samples, bins=100, dtype=np.float64):
+		self.count = 0
+		self.mean = np.zeros(rows)
+		self.m2 = np.zeros(rows)
+		self.bins = bins
+		self.raw = np.empty((samples, rows), dtype=dtype) if samples <= bins else None
+		self.hist = None if samples <= bins else np.zeros((rows, bins), dtype=np.int32)
+		self.index = np.arange(rows)
+
+	def update(self, fx):
+		if self.raw is None:
+			self.hist[self.index, np.clip((fx * self.bins).astype(int), 0, self.bins - 1)] += 1
+		else:
+			self.raw[self.count] = fx
+		self.count += 1
+		delta = fx - self.mean
+		self.mean += delta / self.count
+		self.m2 += delta * (fx - self.mean)
+
+	def histogram(self):
+		if self.raw is None:
+			return self.hist
+		hist = np.zeros((self.index.size, self.bins), dtype=np.int32)
+		np.add.at(hist, (self.index, np.clip((self.raw[:self.count] * self.bins).astype(int), 0, self.bins - 1)), 1)
+		return hist
+
+	def merge(self, other):
+		# Chan et al. pairwise update, so the pooled summary equals one built from all chains' samples
+		count = self.count + other.count
+		if self.raw is not None and other.raw is not None and count <= self.bins:
+			self.raw = np.concatenate([self.raw[:self.count], other.raw[:other.count]])
+		else:  # pooled raw samples would outgrow the histogram
+			self.hist = self.histogram() + other.histogram()
+			self.raw = None
+		delta = other.mean - self.mean
+		self.mean += delta * other.count / max(1, count)
+		self.m2 += other.m2 + np.square(delta) * self.count * other.count / max(1, count)
+		self.count = count
+		return self
+
+	def variance(self):
+		return self.m2 / max(1, self.count)
+
+	def quantile(self, q):
+		if self.raw is not None:
+			return np.quantile(self.raw[:self.count], q, axis=0)
+		# linear within the bin that holds the q-th fraction of the samples
+		cum = np.cumsum(self.hist, axis=1)
+		target = q * self.count
+		b = np.argmax(cum >= target, axis=1)
+		below = cum[self.index, b] - self.hist[self.index, b]
+		return (b + (target - below) / np.maximum(self.hist[self.index, b], 1)) / self.bins
+
+	def save(self, file_name):
+		samples = {'hist': self.hist} if self.raw is None else {'raw': self.raw[:self.count]}
+		np.savez(file_name, count=self.count, mean=self.mean, m2=self.m2, bins=self.bins, **samples)
+
+	@classmethod
+	def load(cls, file_name):
+		dat = np.load(file_name)
+		summary = cls(dat['mean'].size, 0, int(dat['bins']))
+		summary.count = int(dat['count'])
+		summary.mean[:] = dat['mean']
+		summary.m2[:] = dat['m2']
+		summary.raw = dat['raw'] if 'raw' in dat else None
+		summary.hist = dat['hist'] if 'hist' in dat else None
+		return summary
+
 class ptReplica(multiprocessing.Process):
 
-	def __init__(self, w, samples, traindata, testdata, topology, burn_in, temperature, swap_interval, path, parameter_queue, main_process,event):
+	def __init__(self, w, samples, traindata, testdata, topology, burn_in, temperature, swap_interval, path, parameter_queue, main_process,event, dtype=np.float64, langevin=False, bins=100, rng=None):
 		#MULTIPROCESSING VARIABLES
 		multiprocessing.Process.__init__(self)
 		self.processID = temperature
@@ -151,22 +250,34 @@ class ptReplica(multiprocessing.Process):
 		self.traindata = traindata
 		self.testdata = testdata
 		self.w = w
+		self.dtype = dtype  # working precision of the network, data, proposals and posterior buffers
+		self.langevin = langevin  # MALA: random walk around the gradient step of the tempered posterior
+		self.bins = bins  # histogram bins of the predictive summaries
+		self.rng = np.random.default_rng() if rng is None else rng  # this replica's own stream, see ParallelTempering.seed_sequence
 
 	def rmse(self, pred, actual):
-		return np.sqrt(((pred-actual)**2).mean())
+		return np.sqrt(np.mean(np.square(pred-actual), dtype=np.float64))
 
-	def likelihood_func(self, fnn, data, w, tau_sq):
+	def likelihood_func(self, fnn, data, w, tau_sq, fx=None):
+		[loss, fx, rmse] = self.log_likelihood(fnn, data, w, tau_sq, fx=fx)
+		return [loss/self.temperature, fx, rmse]
+
+	def log_likelihood(self, fnn, data, w, tau_sq, fx=None):
+		#Untempered, what run keeps and swaps so a chain at T = inf never multiplies 0 by inf
 		y = data[:, self.topology[0]]
-		fx = fnn.evaluate_proposal(data,w)
+		if fx is None:  # fx is passed in when the gradient pass already computed it
+			fx = fnn.evaluate_proposal(data,w)
 		rmse = self.rmse(fx, y)
-		loss = np.sum(-0.5*np.log(2*math.pi*tau_sq) - 0.5*np.square(y-fx)/tau_sq)
-		return [np.sum(loss)/self.temperature, fx, rmse]
+		#Accumulate in float64 whatever the working dtype, the MH ratio is a small difference of large sums
+		sq_error = np.square(y-fx)
+		loss = -0.5*np.log(2*math.pi*tau_sq)*sq_error.size - 0.5*np.sum(sq_error, dtype=np.float64)/tau_sq
+		return [loss, fx, rmse]
 
 	def prior_likelihood(self, sigma_squared, nu_1, nu_2, w, tausq):
 		h = self.topology[1]  # number hidden neurons
 		d = self.topology[0]  # number input neurons
 		part1 = -1 * ((d * h + h + 2) / 2) * np.log(sigma_squared)
-		part2 = 1 / (2 * sigma_squared) * (sum(np.square(w)))
+		part2 = 1 / (2 * sigma_squared) * np.sum(np.square(w), dtype=np.float64)
 		log_loss = part1 - part2  - (1 + nu_1) * np.log(tausq) - (nu_2 / tausq)
 		return log_loss
 
@@ -183,42 +294,52 @@ class ptReplica(multiprocessing.Process):
 		y_train = self.traindata[:,netw[0]]
 
 		w_size = (netw[0] * netw[1]) + (netw[1] * netw[2]) + netw[1] + netw[2]  # num of weights and bias
-		pos_w = np.ones((samples, w_size)) #Posterior for all weights
+		pos_w = np.ones((samples, w_size), dtype=self.dtype) #Posterior for all weights
 		pos_tau = np.ones((samples,1)) #Tau is the variance of difference in predicted and actual values
 
-		fxtrain_samples = np.ones((samples, trainsize)) #Output of regression FNN for training samples
-		fxtest_samples = np.ones((samples, testsize)) #Output of regression FNN for testing samples
+		#Output of regression FNN for training and testing samples, summarised online after burn-in
+		burnin = int(samples*self.burn_in)
+		fxtrain_current = np.ones(trainsize, dtype=self.dtype)
+		fxtest_current = np.ones(testsize, dtype=self.dtype)
+		retained = samples - max(burnin, 1)  # rows i + 1 >= burnin of the loop below
+		fxtrain_summary = PredictiveSummary(trainsize, retained, self.bins, self.dtype)
+		fxtest_summary = PredictiveSummary(testsize, retained, self.bins, self.dtype)
 		rmse_train  = np.zeros(samples)
 		rmse_test = np.zeros(samples)
+		#Values of the current state carried into the rows of rejected steps, placeholders before the first accept or swap
+		w_record = np.ones(w_size, dtype=self.dtype)
+		rmsetrain_current = rmsetest_current = 0
 		learn_rate = 0.5
 
 		naccept = 0
 		#Random Initialisation of weights
-		w = self.w
+		w = self.w.astype(self.dtype)
 		#print(w,self.temperature)
-		w_proposal = np.random.randn(w_size)
 		#Randomwalk Steps
 		step_w = 0.025
 		step_eta = 0.2
 		#Declare FNN
-		fnn = Network(self.topology, self.traindata, self.testdata, learn_rate)
+		fnn = Network(self.topology, self.traindata, self.testdata, learn_rate, dtype=self.dtype, rng=self.rng)
+		w_proposal = fnn.encode()  # proposals live in the network's parameter buffer
 		#Evaluate Proposals
 		pred_train = fnn.evaluate_proposal(self.traindata,w)
 		pred_test = fnn.evaluate_proposal(self.testdata, w)
 		#Check Variance of Proposal
-		eta = np.log(np.var(pred_train - y_train))
+		eta = np.log(np.var(pred_train - y_train, dtype=np.float64))
 		tau_pro = np.exp(eta)
 		sigma_squared = 25
 		nu_1 = 0
 		nu_2 = 0
-		sigma_diagmat = np.zeros((w_size, w_size))  # for Equation 9 in Ref [Chandra_ICONIP2017]
-		np.fill_diagonal(sigma_diagmat, step_w)
 
 		delta_likelihood = 0.5 # an arbitrary position
 		prior_current = self.prior_likelihood(sigma_squared, nu_1, nu_2, w, tau_pro)  # takes care of the gradients
 		#Evaluate Likelihoods
-		[likelihood, pred_train, rmsetrain] = self.likelihood_func(fnn, self.traindata, w, tau_pro)
+		[likelihood, pred_train, rmsetrain] = self.log_likelihood(fnn, self.traindata, w, tau_pro)
 		[_, pred_test, rmsetest] = self.likelihood_func(fnn, self.testdata, w, tau_pro)
+		fx_train = None
+		diff_prop = 0
+		if self.langevin:
+			grad_current = fnn.evaluate_gradient(self.traindata, w, tau_pro, self.temperature, sigma_squared)
 		#Beginning Sampling using MCMC RANDOMWALK
 		plt.plot(x_train, y_train)
 
@@ -227,54 +348,64 @@ class ptReplica(multiprocessing.Process):
 
 		for i in range(samples - 1):
 			#GENERATING SAMPLE
-			#w_gd = fnn.langevin_gradient(self.traindata, w.copy(), self.sgd_depth) # Eq 8
-			w_proposal = np.random.normal(w, step_w, w_size) # Eq 7
-			#w_prop_gd = fnn.langevin_gradient(self.traindata, w_proposal.copy(), self.sgd_depth)
-
-			#diff_prop =  np.log(multivariate_normal.pdf(w, w_prop_gd, sigma_diagmat)  - np.log(multivariate_normal.pdf(w_proposal, w_gd, sigma_diagmat)))
-
-			eta_pro = eta + np.random.normal(0, step_eta, 1)
+			eta_pro = eta + self.rng.normal(0, step_eta)
 			tau_pro = math.exp(eta_pro)
 
-			[likelihood_proposal, pred_train, rmsetrain] = self.likelihood_func(fnn, self.traindata, w_proposal,tau_pro)
+			if self.langevin:
+				w_gd = w + 0.5 * step_w**2 * grad_current # Eq 8
+				fnn.propose(w_gd, step_w)
+				grad_proposal = fnn.evaluate_gradient(self.traindata, w_proposal, tau_pro, self.temperature, sigma_squared)
+				fx_train = fnn.out.reshape(trainsize)
+				w_prop_gd = w_proposal + 0.5 * step_w**2 * grad_proposal
+				#log q(w | w_proposal) - log q(w_proposal | w) for the N(w_gd, step_w**2 I) proposal, Eq 9
+				diff_prop = (np.sum(np.square(w_proposal - w_gd), dtype=np.float64) - np.sum(np.square(w - w_prop_gd), dtype=np.float64)) / (2 * step_w**2)
+			else:
+				fnn.propose(w, step_w) # Eq 7, fills w_proposal in place
+
+			[likelihood_proposal, pred_train, rmsetrain] = self.log_likelihood(fnn, self.traindata, w_proposal,tau_pro, fx=fx_train)
 
 			[_, pred_test, rmsetest] = self.likelihood_func(fnn, self.testdata, w_proposal,tau_pro)
 			prior_prop = self.prior_likelihood(sigma_squared, nu_1, nu_2, w_proposal,tau_pro)  # takes care of the gradients
 			diff_prior = prior_prop - prior_current
-			diff_likelihood = likelihood_proposal - likelihood
+			diff_likelihood = (likelihood_proposal - likelihood) / self.temperature
 			#ACCEPTANCE OF SAMPLE
 
+			log_ratio = diff_likelihood + diff_prior + diff_prop  # what the accept log records
 			try:
-				mh_prob = min(1, math.exp(diff_likelihood + diff_prior  ))
+				mh_prob = min(1, math.exp(log_ratio))
 			except OverflowError:
 				mh_prob = 1
 
-			u = random.uniform(0, 1)
+			u = self.rng.uniform(0, 1)
 
 
 			if u < mh_prob:
 				naccept  =  naccept + 1
 				likelihood = likelihood_proposal
 				prior_current = prior_prop
-				w = w_proposal
+				np.copyto(w, w_proposal)
 				eta = eta_pro
+				if self.langevin:
+					grad_current = grad_proposal
 				#print (i,'accepted')
-				accept_list.write('{} {} {} {} {} {} {}\n'.format(self.temperature,naccept, i, rmsetrain, rmsetest, likelihood, diff_likelihood + diff_prior))
+				accept_list.write('{} {} {} {} {} {} {}\n'.format(self.temperature,naccept, i, rmsetrain, rmsetest, likelihood / self.temperature, log_ratio))
 				pos_w[i + 1,] = w_proposal
+				np.copyto(w_record, w_proposal)
 				pos_tau[i + 1,] = tau_pro
-				fxtrain_samples[i + 1,] = pred_train
-				fxtest_samples[i + 1,] = pred_test
-				rmse_train[i + 1,] = rmsetrain
-				rmse_test[i + 1,] = rmsetest
+				np.copyto(fxtrain_current, pred_train)
+				np.copyto(fxtest_current, pred_test)
+				rmse_train[i + 1,] = rmsetrain_current = rmsetrain
+				rmse_test[i + 1,] = rmsetest_current = rmsetest
 				plt.plot(x_train, pred_train)
 			else:
-				accept_list.write('{} x {} {} {} {} {}\n'.format(self.temperature, i, rmsetrain, rmsetest, likelihood, diff_likelihood + diff_prior))
-				pos_w[i + 1,] = pos_w[i,]
+				accept_list.write('{} x {} {} {} {} {}\n'.format(self.temperature, i, rmsetrain, rmsetest, likelihood / self.temperature, log_ratio))
+				pos_w[i + 1,] = w_record
 				pos_tau[i + 1,] = pos_tau[i,]
-				fxtrain_samples[i + 1,] = fxtrain_samples[i,]
-				fxtest_samples[i + 1,] = fxtest_samples[i,]
-				rmse_train[i + 1,] = rmse_train[i,]
-				rmse_test[i + 1,] = rmse_test[i,]
+				rmse_train[i + 1,] = rmsetrain_current
+				rmse_test[i + 1,] = rmsetest_current
+			if i + 1 >= burnin:
+				fxtrain_summary.update(fxtrain_current)
+				fxtest_summary.update(fxtest_current)
 			#print('INITIAL W(PROP) BEFORE SWAP',self.temperature,w_proposal,i,rmsetrain)
 			#print('INITIAL W BEFORE SWAP',self.temperature,i,w)
 			#SWAPPING PREP
@@ -283,20 +414,27 @@ class ptReplica(multiprocessing.Process):
 				self.parameter_queue.put(param)
 				self.signal_main.set()
 				self.event.wait()
+				self.event.clear()
 				#print(i, self.temperature)
-				# retrieve parameters fom queues if it has been swapped
-				if not self.parameter_queue.empty() :
-					try:
-						result =  self.parameter_queue.get()
-						#print(self.temperature, w, 'param after swap')
-						w= result[0:w.size]
+				# retrieve parameters fom queues, the main process hands back exactly one whether swapped or not
+				try:
+					result =  self.parameter_queue.get()
+					#print(self.temperature, w, 'param after swap')
+					if result[w.size] != eta or not np.array_equal(result[0:w.size], w):
+						# swapped, the prior and the carried-forward records follow the new state
+						w= result[0:w.size].astype(self.dtype)
 						eta = result[w.size]
 						likelihood = result[w.size+1]
-					except:
-						print ('error')
-		param = np.concatenate([w, np.asarray([eta]).reshape(1), np.asarray([likelihood]),np.asarray([self.temperature])])
-		#print('SWAPPED PARAM',self.temperature,param)
-		self.parameter_queue.put(param)
+						np.copyto(w_record, w)
+						prior_current = self.prior_likelihood(sigma_squared, nu_1, nu_2, w, math.exp(eta))
+						[_, pred_train, rmsetrain_current] = self.likelihood_func(fnn, self.traindata, w, math.exp(eta))
+						[_, pred_test, rmsetest_current] = self.likelihood_func(fnn, self.testdata, w, math.exp(eta))
+						np.copyto(fxtrain_current, pred_train)
+						np.copyto(fxtest_current, pred_test)
+					if self.langevin:
+						grad_current = fnn.evaluate_gradient(self.traindata, w, math.exp(eta), self.temperature, sigma_squared)
+				except:
+					print ('error')
 		make_directory(self.path+'/results')
 		make_directory(self.path+'/posterior')
 		print ((naccept*100 / (samples * 1.0)), '% was accepted')
@@ -307,10 +445,10 @@ class ptReplica(multiprocessing.Process):
 		#SAVING PARAMETERS
 		file_name = self.path+'/posterior/pos_w_chain_'+ str(self.temperature)+ '.txt'
 		np.savetxt(file_name,pos_w )
-		file_name = self.path+'/posterior/fxtrain_samples_chain_'+ str(self.temperature)+ '.txt'
-		np.savetxt(file_name, fxtrain_samples, fmt='%1.2f')
-		file_name = self.path+'/posterior/fxtest_samples_chain_'+ str(self.temperature)+ '.txt'
-		np.savetxt(file_name, fxtest_samples, fmt='%1.2f')
+		file_name = self.path+'/posterior/fxtrain_summary_chain_'+ str(self.temperature)+ '.npz'
+		fxtrain_summary.save(file_name)
+		file_name = self.path+'/posterior/fxtest_summary_chain_'+ str(self.temperature)+ '.npz'
+		fxtest_summary.save(file_name)
 		file_name = self.path+'/posterior/rmse_test_chain_'+ str(self.temperature)+ '.txt'
 		np.savetxt(file_name, rmse_test, fmt='%1.2f')
 		file_name = self.path+'/posterior/rmse_train_chain_'+ str(self.temperature)+ '.txt'
@@ -322,12 +460,18 @@ class ptReplica(multiprocessing.Process):
 
 class ParallelTempering:
 
-	def __init__(self, traindata, testdata, topology, num_chains, maxtemp, NumSample, swap_interval, path):
+	def __init__(self, traindata, testdata, topology, num_chains, maxtemp, NumSample, swap_interval, path, precision='float64', langevin=False, bins=100, seed=None):
 		#FNN Chain variables
-		self.traindata = traindata
-		self.testdata = testdata
+		self.dtype = np.dtype(precision)  # 'float32' halves memory traffic; likelihoods and MH ratios stay in float64
+		self.traindata = traindata.astype(self.dtype, copy=False)
+		self.testdata = testdata.astype(self.dtype, copy=False)
 		self.topology = topology
+		self.langevin = langevin  # MALA proposals in every replica instead of the plain random walk
+		self.bins = bins  # predictive quantiles: raw samples up to bins per chain, a bins-bin histogram past that
 		self.num_param = (topology[0] * topology[1]) + (topology[1] * topology[2]) + topology[1] + topology[2]
+		#RANDOM STREAMS: one SeedSequence drives the coordinator and, spawned, an independent Generator per replica
+		self.seed_sequence = np.random.SeedSequence(seed)
+		self.rng = np.random.default_rng(self.seed_sequence)
 		#Parallel Tempering variables
 		self.swap_interval = swap_interval
 		self.path = path
@@ -341,7 +485,6 @@ class ParallelTempering:
 		self.sub_sample_size = max(1, int( 0.05* self.NumSamples))
 		# create queues for transfer of parameters between process chain
 		self.parameter_queue = [multiprocessing.Queue() for i in range(num_chains)]
-		self.chain_queue = multiprocessing.JoinableQueue()
 		self.wait_chain = [multiprocessing.Event() for i in range (self.num_chains)]
 		self.event = [multiprocessing.Event() for i in range (self.num_chains)]
 
@@ -450,40 +593,32 @@ class ParallelTempering:
 	def initialize_chains(self, burn_in):
 		self.burn_in = burn_in
 		self.assign_temperatures()
-		w = np.random.randn(self.num_param)
+		w = self.rng.standard_normal(self.num_param).astype(self.dtype)
+		replica_rng = [np.random.default_rng(child) for child in self.seed_sequence.spawn(self.num_chains)]
 
 		for i in range(0, self.num_chains):
-			self.chains.append(ptReplica(w,self.NumSamples,self.traindata,self.testdata,self.topology,self.burn_in,self.temperatures[i],self.swap_interval,self.path,self.parameter_queue[i],self.wait_chain[i],self.event[i]))
+			self.chains.append(ptReplica(w,self.NumSamples,self.traindata,self.testdata,self.topology,self.burn_in,self.temperatures[i],self.swap_interval,self.path,self.parameter_queue[i],self.wait_chain[i],self.event[i],dtype=self.dtype,langevin=self.langevin,bins=self.bins,rng=replica_rng[i]))
 
 	def swap_procedure(self, parameter_queue_1, parameter_queue_2):
-		if parameter_queue_2.empty() is False and parameter_queue_1.empty() is False:
-			param1 = parameter_queue_1.get()
-			param2 = parameter_queue_2.get()
-			w1 = param1[0:self.num_param]
-			eta1 = param1[self.num_param]
-			lhood1 = param1[self.num_param+1]
-			T1 = param1[self.num_param+2]
-			w2 = param2[0:self.num_param]
-			eta2 = param2[self.num_param]
-			lhood2 = param2[self.num_param+1]
-			T2 = param2[self.num_param+2]
-			#print('yo')
-			#SWAPPING PROBABILITIES
-			try:
-				swap_proposal =  min(1,0.5*np.exp(lhood2 - lhood1))
-			except OverflowError:
-				swap_proposal = 1
-			u = np.random.uniform(0,1)
-			if u < swap_proposal:
-				self.total_swap_proposals += 1
-				self.num_swap += 1
-				param_temp =  param1
-				param1 = param2
-				param2 = param_temp
-			return param1, param2
-		else:
-			self.total_swap_proposals += 1
-			return
+		# blocking gets: both chains have put their param before signalling
+		param1 = parameter_queue_1.get()
+		param2 = parameter_queue_2.get()
+		# params carry the untempered likelihood and their chain's temperature
+		lhood1 = param1[self.num_param+1] / param1[self.num_param+2]
+		lhood2 = param2[self.num_param+1] / param2[self.num_param+2]
+		#SWAPPING PROBABILITIES
+		try:
+			swap_proposal =  min(1,0.5*np.exp(min(709,lhood2 - lhood1)))
+		except OverflowError:
+			swap_proposal = 1
+		u = self.rng.uniform(0,1)
+		self.total_swap_proposals += 1
+		if u < swap_proposal:
+			self.num_swap += 1
+			param_temp =  param1
+			param1 = param2
+			param2 = param_temp
+		return param1, param2
 
 	def plot_figure(self, list, title):
 
@@ -562,52 +697,26 @@ class ParallelTempering:
 		for j in range(0,self.num_chains):
 			self.chains[j].start()
 		#SWAP PROCEDURE
-		#chain_num = 0
-
-		while True:
+		#Every replica stops at the same iterations, so the rounds are counted rather than polled. A round waits for all
+		#chains, swaps neighbours in order and hands exactly one param back to each, which keeps seeded runs repeatable
+		for swap_round in range(len(range(0, self.NumSamples - 1, self.swap_interval))):
 			for k in range(0,self.num_chains):
 				self.wait_chain[k].wait()
-				#print(chain_num)
+				self.wait_chain[k].clear()
 			for k in range(0,self.num_chains-1):
-				#print('starting swap')
-				self.chain_queue.put(self.swap_procedure(self.parameter_queue[k],self.parameter_queue[k+1]))
-				while True:
-					if self.chain_queue.empty():
-						self.chain_queue.task_done()
-						#print(k,'EMPTY QUEUE')
-						break
-					swap_process = self.chain_queue.get()
-					#print(swap_process)
-					if swap_process is None:
-						self.chain_queue.task_done()
-						#print(k,'No Process')
-						break
-					param1, param2 = swap_process
-
-					self.parameter_queue[k].put(param1)
-					self.parameter_queue[k+1].put(param2)
+				param1, param2 = self.swap_procedure(self.parameter_queue[k],self.parameter_queue[k+1])
+				self.parameter_queue[k].put(param1)
+				self.parameter_queue[k+1].put(param2)
 			for k in range (self.num_chains):
-					#print(k)
 					self.event[k].set()
-			count = 0
-			for i in range(self.num_chains):
-				if self.chains[i].is_alive() is False:
-					count+=1
-			if count == self.num_chains  :
-				#print(count)
-				break
-
 
 		#JOIN THEM TO MAIN PROCESS
 		for j in range(0,self.num_chains):
 			self.chains[j].join()
-		self.chain_queue.join()
 		#GETTING DATA
 		burnin = int(self.NumSamples*self.burn_in)
-		pos_w = np.zeros((self.num_chains,self.NumSamples - burnin, self.num_param))
-		fxtrain_samples = np.zeros((self.num_chains,self.NumSamples - burnin, self.traindata.shape[0]))
+		pos_w = np.zeros((self.num_chains,self.NumSamples - burnin, self.num_param), dtype=self.dtype)
 		rmse_train = np.zeros((self.num_chains,self.NumSamples - burnin))
-		fxtest_samples = np.zeros((self.num_chains,self.NumSamples - burnin, self.testdata.shape[0]))
 		rmse_test = np.zeros((self.num_chains,self.NumSamples - burnin))
 		accept_ratio = np.zeros((self.num_chains,1))
 
@@ -615,12 +724,11 @@ class ParallelTempering:
 			file_name = self.path+'/posterior/pos_w_chain_'+ str(self.temperatures[i])+ '.txt'
 			dat = np.loadtxt(file_name)
 			pos_w[i,:,:] = dat[burnin:,:]
-			file_name = self.path+'/posterior/fxtrain_samples_chain_'+ str(self.temperatures[i])+ '.txt'
-			dat = np.loadtxt(file_name)
-			fxtrain_samples[i,:,:] = dat[burnin:,:]
-			file_name = self.path+'/posterior/fxtest_samples_chain_'+ str(self.temperatures[i])+ '.txt'
-			dat = np.loadtxt(file_name)
-			fxtest_samples[i,:,:] = dat[burnin:,:]
+			#Predictions of all chains pooled, as summaries
+			file_name = self.path+'/posterior/fxtrain_summary_chain_'+ str(self.temperatures[i])+ '.npz'
+			fx_train = PredictiveSummary.load(file_name) if i == 0 else fx_train.merge(PredictiveSummary.load(file_name))
+			file_name = self.path+'/posterior/fxtest_summary_chain_'+ str(self.temperatures[i])+ '.npz'
+			fx_test = PredictiveSummary.load(file_name) if i == 0 else fx_test.merge(PredictiveSummary.load(file_name))
 			file_name = self.path+'/posterior/rmse_test_chain_'+ str(self.temperatures[i])+ '.txt'
 			dat = np.loadtxt(file_name)
 			rmse_test[i,:] = dat[burnin:]
@@ -633,9 +741,7 @@ class ParallelTempering:
 
 		pos_w = pos_w.transpose(2,0,1).reshape(self.num_param,-1)
 		accept_total = np.sum(accept_ratio)/self.num_chains
-		fx_train = fxtrain_samples.reshape(self.num_chains*(self.NumSamples - burnin), self.traindata.shape[0])
 		rmse_train = rmse_train.reshape(self.num_chains*(self.NumSamples - burnin), 1)
-		fx_test = fxtest_samples.reshape(self.num_chains*(self.NumSamples - burnin), self.testdata.shape[0])
 		rmse_test = rmse_test.reshape(self.num_chains*(self.NumSamples - burnin), 1)
 		for s in range(self.num_param):
 			self.plot_figure(pos_w[s,:], 'pos_distri_'+str(s))
@@ -694,6 +800,7 @@ def main():
 		swap_ratio = 0.125
 		num_chains = 10
 		burn_in = 0.2
+		seed = None  # an int makes the run reproducible
 
 		###############################
 
@@ -702,7 +809,7 @@ def main():
 		path = "RESULTS/"+name+"_results_"+str(NumSample)+"_"+str(maxtemp)+"_"+str(num_chains)+"_"+str(swap_ratio)
 		make_directory(path)
 		print(path)
-		pt = ParallelTempering(traindata, testdata, topology, num_chains, maxtemp, NumSample, swap_interval, path)
+		pt = ParallelTempering(traindata, testdata, topology, num_chains, maxtemp, NumSample, swap_interval, path, seed=seed)
 		pt.initialize_chains(burn_in)
 
 		pos_w, fx_train, fx_test, x_train, x_test, rmse_train, rmse_test, accept_total = pt.run_chains()
@@ -714,13 +821,13 @@ def main():
 		print ((timer2 - timer), 'sec time taken')
 
 		#PLOTS
-		fx_mu = fx_test.mean(axis=0)
-		fx_high = np.percentile(fx_test, 95, axis=0)
-		fx_low = np.percentile(fx_test, 5, axis=0)
+		fx_mu = fx_test.mean
+		fx_high = fx_test.quantile(0.95)
+		fx_low = fx_test.quantile(0.05)
 
-		fx_mu_tr = fx_train.mean(axis=0)
-		fx_high_tr = np.percentile(fx_train, 95, axis=0)
-		fx_low_tr = np.percentile(fx_train, 5, axis=0)
+		fx_mu_tr = fx_train.mean
+		fx_high_tr = fx_train.quantile(0.95)
+		fx_low_tr = fx_train.quantile(0.05)
 
 		rmse_tr = np.mean(rmse_train[:])
 		rmsetr_std = np.std(rmse_train[:])
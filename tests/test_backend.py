@@ -0,0 +1,52 @@
+
+""" Compute backends in pt_bntl: the numba kernels against the numpy ones"""
+
+import numpy as np
+import pytest
+
+import pt_bntl
+
+TOPOLOGY = [6, 5, 2]
+
+def make_data(rng, rows, topology, dtype):
+	x = rng.random((rows, topology[0]))
+	x[rng.random(x.shape) < 0.3] = 0  # the fused kernel skips zero inputs
+	return np.hstack([x, rng.random((rows, topology[-1]))]).astype(dtype)
+
+def test_unknown_backend():
+	with pytest.raises(ValueError):
+		pt_bntl.make_backend('no such backend')
+
+@pytest.mark.parametrize('dtype, rtol', [(np.float64, 1e-12), (np.float32, 1e-5)])
+def test_numba_matches_numpy(dtype, rtol):
+	pytest.importorskip('numba')
+	rng = np.random.default_rng(0)
+	data = make_data(rng, 50, TOPOLOGY, dtype)
+	fnn = pt_bntl.Network(TOPOLOGY, data, data, 0.1, dtype=dtype)
+	w = rng.standard_normal(pt_bntl.num_weights(TOPOLOGY)).astype(dtype)
+	numpy_backend = pt_bntl.make_backend('numpy')
+	numba_backend = pt_bntl.make_backend('numba')
+	assert type(numba_backend) is pt_bntl.NumbaBackend
+	loss, fx, rmse = numba_backend.gaussian_likelihood(fnn, data, w, 0.3)
+	expected_loss, expected_fx, expected_rmse = numpy_backend.gaussian_likelihood(fnn, data, w, 0.3)
+	assert fx.dtype == expected_fx.dtype
+	np.testing.assert_allclose(fx, expected_fx, rtol=rtol)
+	assert loss == pytest.approx(expected_loss, rel=rtol)
+	assert rmse == pytest.approx(expected_rmse, rel=rtol)
+	assert numba_backend.sum_squares(w) == pytest.approx(numpy_backend.sum_squares(w), rel=rtol)
+
+def test_numba_falls_back_to_numpy():
+	pytest.importorskip('numba')
+	rng = np.random.default_rng(1)
+	numba_backend = pt_bntl.make_backend('numba')
+	numpy_backend = pt_bntl.make_backend('numpy')
+	topology = [6, 5, 4, 2]
+	data = make_data(rng, 30, topology, np.float64)
+	deep = pt_bntl.DeepNetwork(topology, data, data, 0.1)
+	w = rng.standard_normal(pt_bntl.num_weights(topology))
+	assert numba_backend.gaussian_likelihood(deep, data, w, 0.3)[0] == numpy_backend.gaussian_likelihood(deep, data, w, 0.3)[0]
+	data = make_data(rng, 30, TOPOLOGY, np.float64)
+	fnn = pt_bntl.Network(TOPOLOGY, data, data, 0.1)
+	w = rng.standard_normal(pt_bntl.num_weights(TOPOLOGY))
+	fx = fnn.evaluate_proposal(data, w)
+	assert numba_backend.gaussian_likelihood(fnn, data, w, 0.3, fx=fx)[0] == numpy_backend.gaussian_likelihood(fnn, data, w, 0.3, fx=fx)[0]
@@ -0,0 +1,50 @@
+
+""" BayesianTL network and likelihoods in bntl_v1_0"""
+
+import numpy as np
+import pytest
+
+import bntl_v1_0
+
+def test_batched_proposal_matches_row_loop():
+	rng = np.random.default_rng(0)
+	topology = [4, 6, 3]
+	data = rng.random((25, topology[0] + topology[2]))
+	network = bntl_v1_0.Network(topology, data, data)
+	w = rng.standard_normal(topology[0]*topology[1] + topology[1]*topology[2] + topology[1] + topology[2])
+	np.testing.assert_allclose(network.evaluate_proposal(data, w, batch=True), network.evaluate_proposal(data, w, batch=False), rtol=1e-12)
+
+def loop_multinomial_likelihood(neural_network, data, weights):
+	#the element loops multinomial_likelihood replaced, with the slicing and names fixed and without the + 0.0001 inside the log
+	y = data[:, neural_network.Top[0]: neural_network.Top[0] + neural_network.Top[2]]
+	fx = neural_network.evaluate_proposal(data, weights, batch=False)
+	probability = neural_network.softmax(fx)
+	loss = 0
+	for index_1 in range(y.shape[0]):
+		for index_2 in range(y.shape[1]):
+			if y[index_1, index_2] == 1:
+				loss += np.log(probability[index_1, index_2])
+	out = np.argmax(fx, axis=1)
+	y_out = np.argmax(y, axis=1)
+	count = 0
+	for index in range(y_out.shape[0]):
+		if out[index] == y_out[index]:
+			count += 1
+	accuracy = float(count)/y_out.shape[0] * 100
+	return [loss, accuracy]
+
+@pytest.mark.parametrize('precision', ['float64', 'float32'])
+def test_multinomial_likelihood_matches_loop(precision):
+	rng = np.random.default_rng(0)
+	topology = [4, 6, 3]
+	x = rng.random((25, topology[0]))
+	y = np.eye(topology[2])[rng.integers(0, topology[2], 25)]
+	data = np.hstack([x, y]).astype(precision)
+	network = bntl_v1_0.Network(topology, data, data, dtype=np.dtype(precision))
+	w = rng.standard_normal(network.w.size).astype(precision)
+	loss, rmse, accuracy = bntl_v1_0.BayesianTL.multinomial_likelihood(network, data, w)
+	expected_loss, expected_accuracy = loop_multinomial_likelihood(network, data, w)
+	assert loss == pytest.approx(expected_loss, rel=1e-12 if precision == 'float64' else 1e-5)
+	assert accuracy == pytest.approx(expected_accuracy)
+	fx = network.evaluate_proposal(data, w)
+	assert rmse == pytest.approx(np.sqrt(np.mean(np.square(fx - y))), rel=1e-6)
@@ -0,0 +1,49 @@
+
+""" Adaptive temperature ladder of ParallelTemperingTL"""
+
+from multiprocessing.sharedctypes import RawArray
+
+import numpy as np
+import pytest
+
+import pt_bntl
+
+class Ladder(object):
+	#the attributes adapt_temperatures reads, without starting any replicas
+	adapt_temperatures = pt_bntl.ParallelTemperingTL.adapt_temperatures
+
+	def __init__(self, temperatures, adaptation_lag=100, adaptation_time=10):
+		self.ladders = [RawArray('d', len(temperatures))]
+		self.ladders[0][:] = temperatures
+		self.adaptation_lag = adaptation_lag
+		self.adaptation_time = adaptation_time
+
+@pytest.mark.parametrize('rates', [False, True])
+@pytest.mark.parametrize('seed', range(5))
+def test_gaps_follow_acceptance(seed, rates):
+	rng = np.random.default_rng(seed)
+	pt = Ladder(np.geomspace(1.0, 20.0, 6), adaptation_time=2)
+	for swap_round in range(20):
+		before = np.array(pt.ladders[0])
+		#one round's swap outcomes, or acceptance rates pooled over several rounds
+		accepted = rng.random(5) if rates else rng.random(5) < 0.5
+		pt.adapt_temperatures(0, accepted, swap_round)
+		after = np.array(pt.ladders[0])
+		assert after[0] == before[0] and after[-1] == before[-1]
+		assert np.all(np.diff(after) > 0)
+		change = np.diff(after) - np.diff(before)
+		mean = np.mean(accepted)
+		if mean in (0.0, 1.0):  # every pair alike, nothing to move
+			np.testing.assert_array_equal(after, before)
+			continue
+		assert np.all(change[accepted < mean] < 0)
+		assert np.all(change[accepted > mean] > 0)
+
+def test_decays_with_rounds():
+	accepted = np.array([True, False, False, True])
+	moves = []
+	for swap_round in (0, 100, 1000):
+		pt = Ladder(np.geomspace(1.0, 10.0, 5))
+		pt.adapt_temperatures(0, accepted, swap_round)
+		moves.append(np.max(np.abs(np.array(pt.ladders[0]) - np.geomspace(1.0, 10.0, 5))))
+	assert moves[0] > moves[1] > moves[2] > 0
@@ -0,0 +1,137 @@
+
+""" Vectorized Network kernels in pt_bntl against their direct forms"""
+
+import numpy as np
+import pytest
+
+import pt_bntl
+
+SHALLOW = [6, 5, 2]
+DEEP = [6, 5, 4, 2]
+
+def make_data(rng, rows, topology, sparse=False):
+	x = rng.random((rows, topology[0]))
+	if sparse:  # mostly a constant nonzero baseline, like an undetected WAP in UJIndoorLoc
+		x = np.where(rng.random(x.shape) < 0.8, 100.0, x)
+	y = rng.random((rows, topology[-1]))
+	return np.hstack([x, y])
+
+def make_network(topology, data):
+	cls = pt_bntl.Network if len(topology) == 3 else pt_bntl.DeepNetwork
+	return cls(topology, data, data, 0.1)
+
+def make_replica(topology, temperature):
+	#the attributes the likelihood methods read, without starting a process
+	replica = pt_bntl.ptReplica.__new__(pt_bntl.ptReplica)
+	replica.topology = topology
+	replica.temperature = temperature
+	replica.backend = pt_bntl.NumpyBackend()
+	return replica
+
+def log_posterior(fnn, data, w, tau_sq, temperature, sigma_squared):
+	fx = fnn.evaluate_proposal(data, w)
+	return -0.5*np.sum(np.square(data[:, fnn.Top[0]:] - fx))/(tau_sq*temperature) - 0.5*np.sum(np.square(w))/sigma_squared
+
+def test_batched_proposal_matches_row_loop():
+	rng = np.random.default_rng(1)
+	data = make_data(rng, 40, SHALLOW)
+	fnn = make_network(SHALLOW, data)
+	w = rng.standard_normal(pt_bntl.num_weights(SHALLOW))
+	np.testing.assert_allclose(fnn.evaluate_proposal(data, w, batch=True), fnn.evaluate_proposal(data, w, batch=False), rtol=1e-12)
+
+def test_batched_likelihood_matches_row_loop():
+	rng = np.random.default_rng(2)
+	data = make_data(rng, 40, SHALLOW)
+	fnn = make_network(SHALLOW, data)
+	w = rng.standard_normal(pt_bntl.num_weights(SHALLOW))
+	tau_sq, temperature = 0.3, 2.0
+	loss, fx, rmse = make_replica(SHALLOW, temperature).likelihood_func(fnn, data, w, tau_sq)
+	expected = 0.0
+	total = 0.0
+	for row in data:
+		fnn.ForwardPass(row[0:SHALLOW[0]])
+		error = np.sum(np.square(row[SHALLOW[0]:] - fnn.out))
+		expected += -0.5*np.log(2*np.pi*tau_sq)*SHALLOW[-1] - 0.5*error/tau_sq
+		total += error
+	assert loss == pytest.approx(expected/temperature, rel=1e-12)
+	assert rmse == pytest.approx(np.sqrt(total/data[:, SHALLOW[0]:].size), rel=1e-12)
+
+@pytest.mark.parametrize('topology', [SHALLOW, DEEP])
+def test_evaluate_proposals_matches_single_evaluations(topology):
+	rng = np.random.default_rng(3)
+	data = make_data(rng, 30, topology)
+	fnn = make_network(topology, data)
+	w_stack = rng.standard_normal((4, pt_bntl.num_weights(topology)))
+	fx = fnn.evaluate_proposals(data, w_stack)
+	assert fx.shape == (4, 30, topology[-1])
+	for k in range(4):
+		np.testing.assert_allclose(fx[k], fnn.evaluate_proposal(data, w_stack[k]), rtol=1e-12)
+
+def test_likelihood_batch_matches_single_likelihoods():
+	rng = np.random.default_rng(4)
+	data = make_data(rng, 30, SHALLOW)
+	fnn = make_network(SHALLOW, data)
+	replica = make_replica(SHALLOW, 3.0)
+	w_stack = rng.standard_normal((4, pt_bntl.num_weights(SHALLOW)))
+	tau_sq = np.array([0.1, 0.2, 0.5, 1.0])
+	loss, fx, rmse = replica.likelihood_batch(fnn, data, w_stack, tau_sq)
+	for k in range(4):
+		single_loss, single_fx, single_rmse = replica.likelihood_func(fnn, data, w_stack[k], tau_sq[k])
+		assert loss[k] == pytest.approx(single_loss, rel=1e-12)
+		assert rmse[k] == pytest.approx(single_rmse, rel=1e-12)
+		np.testing.assert_allclose(fx[k], single_fx, rtol=1e-12)
+
+@pytest.mark.parametrize('topology', [SHALLOW, DEEP])
+def test_sparse_inputs_match_dense(topology):
+	rng = np.random.default_rng(6)
+	data = make_data(rng, 30, topology, sparse=True)
+	inputs = pt_bntl.sparse_inputs(data, topology[0], 0.3)
+	assert inputs is not None and inputs.baseline == 100.0
+	fnn = make_network(topology, data)
+	w = rng.standard_normal(pt_bntl.num_weights(topology)) * 0.05
+	w_stack = rng.standard_normal((3, pt_bntl.num_weights(topology))) * 0.05
+	np.testing.assert_allclose(fnn.evaluate_proposal(data, w, inputs=inputs), fnn.evaluate_proposal(data, w), rtol=1e-10)
+	np.testing.assert_allclose(fnn.evaluate_proposals(data, w_stack, inputs=inputs), fnn.evaluate_proposals(data, w_stack), rtol=1e-10)
+	np.testing.assert_allclose(fnn.evaluate_gradient(data, w, 0.2, 1.0, 25.0, inputs=inputs), fnn.evaluate_gradient(data, w, 0.2, 1.0, 25.0), rtol=1e-8, atol=1e-10)
+	rows = np.array([3, 17, 4])
+	np.testing.assert_allclose(fnn.evaluate_proposal(data[rows], w, inputs=inputs.take(rows)), fnn.evaluate_proposal(data[rows], w), rtol=1e-10)
+
+def test_dense_inputs_keep_dense_path():
+	rng = np.random.default_rng(7)
+	assert pt_bntl.sparse_inputs(make_data(rng, 30, SHALLOW), SHALLOW[0], 0.3) is None
+
+def test_block_update_matches_full_forward_pass():
+	rng = np.random.default_rng(5)
+	data = make_data(rng, 30, SHALLOW)
+	X = data[:, 0:SHALLOW[0]]
+	fnn = make_network(SHALLOW, data)
+	w_current = rng.standard_normal(pt_bntl.num_weights(SHALLOW))
+	cache = fnn.forward_cache(X, w_current)
+	#a run of accepted block moves, every hidden unit and the output layer
+	for block in list(range(len(fnn.blocks))) * 2:
+		w_proposal = fnn.propose_block(w_current, 0.5, block).copy()
+		changed = np.flatnonzero(w_proposal != w_current)
+		assert set(changed) <= set(fnn.blocks[block])
+		fx, update = fnn.evaluate_block(X, cache, w_proposal, block, w_current)
+		np.testing.assert_allclose(fx, fnn.evaluate_proposal(data, w_proposal), rtol=1e-10, atol=1e-12)
+		fnn.commit_block(cache, update)
+		w_current = w_proposal
+		hidout, z2 = fnn.forward_cache(X, w_current)
+		np.testing.assert_allclose(cache[0], hidout, rtol=1e-10, atol=1e-12)
+		np.testing.assert_allclose(cache[1], z2, rtol=1e-10, atol=1e-12)
+
+@pytest.mark.parametrize('topology', [SHALLOW, DEEP])
+def test_gradient_matches_finite_differences(topology):
+	rng = np.random.default_rng(4)
+	data = make_data(rng, 25, topology)
+	fnn = make_network(topology, data)
+	w = rng.standard_normal(pt_bntl.num_weights(topology))
+	tau_sq, temperature, sigma_squared = 0.2, 2.0, 25.0
+	grad = fnn.evaluate_gradient(data, w, tau_sq, temperature, sigma_squared)
+	eps = 1e-6
+	numeric = np.zeros(w.size)
+	for i in range(w.size):
+		step = np.zeros(w.size)
+		step[i] = eps
+		numeric[i] = (log_posterior(fnn, data, w + step, tau_sq, temperature, sigma_squared) - log_posterior(fnn, data, w - step, tau_sq, temperature, sigma_squared)) / (2*eps)
+	np.testing.assert_allclose(grad, numeric, rtol=1e-5, atol=1e-7)
@@ -0,0 +1,235 @@
+
+""" Posterior files: SampleWriter, read_posterior, what a run stores and relabel_chains"""
+
+import os
+
+import numpy as np
+import pytest
+
+import pt_bntl
+
+def test_round_trip_across_chunks(tmp_path):
+	file_name = str(tmp_path / 'pos_w.bin')
+	rows = np.random.default_rng(0).standard_normal((37, 5)).astype(np.float32)
+	#a chunk of 8 rows, so the file is written in several flushes plus a partial one on close
+	writer = pt_bntl.SampleWriter(file_name, (5,), np.float32, dict(topology=[2, 1, 1], temperature=2.5), chunk_bytes=8 * 5 * 4)
+	for row in rows:
+		writer.append(row)
+	writer.close()
+	posterior, header = pt_bntl.read_posterior(file_name)
+	assert posterior.dtype == np.float32 and posterior.shape == rows.shape
+	np.testing.assert_array_equal(posterior, rows)
+	assert header['topology'] == [2, 1, 1] and header['temperature'] == 2.5 and header['row_shape'] == [5]
+
+def test_round_trip_structured_records(tmp_path):
+	file_name = str(tmp_path / 'acceptlist.bin')
+	records = np.zeros(6, dtype=pt_bntl.ACCEPT_RECORD)
+	records['iteration'] = np.arange(1, 7)
+	records['accepted'] = [True, False, True, True, False, False]
+	records['likelihood'] = np.linspace(-3, 3, 6)
+	writer = pt_bntl.SampleWriter(file_name, (), pt_bntl.ACCEPT_RECORD)
+	for record in records:
+		writer.append(record)
+	writer.close()
+	log, header = pt_bntl.read_posterior(file_name)
+	assert log.dtype == pt_bntl.ACCEPT_RECORD
+	np.testing.assert_array_equal(log, records)
+
+def test_partial_and_empty_files(tmp_path):
+	file_name = str(tmp_path / 'pos_w.bin')
+	writer = pt_bntl.SampleWriter(file_name, (3,), np.float64)
+	writer.close()
+	posterior, header = pt_bntl.read_posterior(file_name)
+	assert posterior.shape == (0, 3)
+	writer = pt_bntl.SampleWriter(file_name, (3,), np.float64)
+	writer.append([1.0, 2.0, 3.0])
+	writer.close()
+	with open(file_name, 'ab') as f:  # a replica killed part way through a row
+		f.write(np.zeros(2).tobytes())
+	posterior, header = pt_bntl.read_posterior(file_name)
+	np.testing.assert_array_equal(posterior, [[1.0, 2.0, 3.0]])
+	with open(file_name, 'wb') as f:
+		f.write(b'not a posterior file')
+	with pytest.raises(ValueError):
+		pt_bntl.read_posterior(file_name)
+
+def kept_rows(samples, burn_in, thin, keep_burn_in):
+	#every thin-th iteration counted from burn-in, on both sides of it when keep_burn_in
+	burnin = int(samples*burn_in)
+	return np.arange(burnin % thin if keep_burn_in else burnin, samples, thin)
+
+@pytest.mark.parametrize('thin', [1, 3, 7])
+@pytest.mark.parametrize('keep_burn_in', [True, False])
+def test_stored_rows_grid(thin, keep_burn_in):
+	np.testing.assert_array_equal(np.flatnonzero(pt_bntl.stored_rows(50, 0.25, thin, keep_burn_in)), kept_rows(50, 0.25, thin, keep_burn_in))
+
+def make_data(rng, rows, topology):
+	x = rng.random((rows, topology[0]))
+	return np.hstack([x, 1/(1 + np.exp(-(x[:, :topology[-1]] - 0.5)))])
+
+@pytest.mark.parametrize('thin, keep_burn_in, swap_labels', [(1, True, False), (3, True, False), (3, False, False), (3, False, True)])
+def test_run_writes_stored_rows(tmp_path, monkeypatch, thin, keep_burn_in, swap_labels):
+	monkeypatch.chdir(tmp_path)
+	rng = np.random.default_rng(0)
+	topology = [6, 5, 2]
+	samples, burn_in = 120, 0.2
+	pt = pt_bntl.ParallelTemperingTL(3, samples, 1, [make_data(rng, 60, topology)], [make_data(rng, 30, topology)], make_data(rng, 60, topology), make_data(rng, 30, topology), topology, str(tmp_path / 'res'), 5, 10, seed=1, swap_labels=swap_labels)
+	pt.initialize_chains(burn_in, thin=thin, keep_burn_in=keep_burn_in)
+	pt.run_chains()
+	expected = np.sum(pt_bntl.stored_rows(pt.num_samples, burn_in, thin, keep_burn_in))  # samples are shared out over the chains
+	for task in ('source_0', 'target'):
+		posterior = str(tmp_path / 'res' / task / 'posterior') + '/'
+		for temperature in pt.temperatures:
+			pos_w, header = pt_bntl.read_posterior(posterior + 'pos_w_chain_' + str(temperature) + '.bin')
+			assert pos_w.shape == (expected, pt.num_param)
+			assert header['temperature'] == temperature and header['thin'] == thin and header['keep_burn_in'] == keep_burn_in
+			assert np.all(np.isfinite(pos_w))
+			assert np.loadtxt(posterior + 'rmse_train_chain_' + str(temperature) + '.txt', ndmin=1).size == expected
+		for temperature in pt.temperatures:
+			log, header = pt_bntl.read_posterior(str(tmp_path / 'res' / task / ('acceptlist_' + str(temperature) + '.bin')))
+			np.testing.assert_array_equal(log['iteration'], np.arange(pt.num_samples - 1))
+			accept = np.loadtxt(posterior + 'accept_list_chain_' + str(temperature) + '_accept.txt')
+			assert accept == pytest.approx(np.sum(log['accepted']) * 100 / pt.num_samples, abs=0.01)
+		assert not [name for name in os.listdir(posterior) if 'replica_' in name]
+
+class Relabel(object):
+	#the attributes relabel_chains reads, without starting any replicas
+	relabel_chains = pt_bntl.ParallelTemperingTL.relabel_chains
+
+	def __init__(self, num_chains, num_samples, burn_in, thin, keep_burn_in):
+		self.num_chains = num_chains
+		self.num_samples = num_samples
+		self.burn_in = burn_in
+		self.thin = thin
+		self.keep_burn_in = keep_burn_in
+		self.save_fx = False
+		self.temperatures = [2.0 ** k for k in range(num_chains)]
+
+def write_replicas(directory, pt, slots):
+	#every value a replica writes encodes (replica, iteration), so the relabelled files show where each row came from
+	posterior = directory + '/posterior/'
+	os.makedirs(posterior)
+	stored = np.flatnonzero(pt_bntl.stored_rows(pt.num_samples, pt.burn_in, pt.thin, pt.keep_burn_in))
+	for c_index in range(pt.num_chains):
+		tag = 'replica_' + str(c_index)
+		writer = pt_bntl.SampleWriter(posterior + 'pos_w_chain_' + tag + '.bin', (2,), np.float64, dict(temperature=None))
+		for j in stored:
+			writer.append([c_index, j])
+		writer.close()
+		#record i is the move from iteration i to i + 1
+		writer = pt_bntl.SampleWriter(directory + '/acceptlist_' + tag + '.bin', (), pt_bntl.ACCEPT_RECORD, dict(temperature=None))
+		for i in range(pt.num_samples - 1):
+			writer.append((i, i % 2 == 0, 0, 0, c_index, 0))
+		writer.close()
+		for name in ('rmse_test_chain_', 'rmse_train_chain_'):
+			np.savetxt(posterior + name + tag + '.txt', c_index*1000 + stored, fmt='%.2f')
+		np.savetxt(posterior + 'rows_used_chain_' + tag + '.txt', c_index*1000 + np.arange(pt.num_samples), fmt='%d')
+		np.savetxt(posterior + 'labels_chain_' + tag + '.txt', slots[c_index], fmt='%d')
+		np.savetxt(posterior + 'accept_list_chain_' + tag + '_accept.txt', [0.0])
+	return stored
+
+@pytest.mark.parametrize('thin, keep_burn_in', [(1, True), (3, False)])
+def test_relabel_follows_the_label_permutation(tmp_path, thin, keep_burn_in):
+	pt = Relabel(4, 40, 0.25, thin, keep_burn_in)
+	rng = np.random.default_rng(8)
+	#slots[c, j] is the ladder slot replica c holds at iteration j, a permutation of the slots at every iteration
+	slots = np.array([rng.permutation(pt.num_chains) for j in range(pt.num_samples)]).T
+	directory = str(tmp_path)
+	stored = write_replicas(directory, pt, slots)
+	pt.relabel_chains(directory)
+	posterior = directory + '/posterior/'
+	sources = []
+	for k, temperature in enumerate(pt.temperatures):
+		pos_w, header = pt_bntl.read_posterior(posterior + 'pos_w_chain_' + str(temperature) + '.bin')
+		assert header['temperature'] == temperature
+		replica = pos_w[:, 0].astype(int)
+		np.testing.assert_array_equal(pos_w[:, 1], stored)
+		np.testing.assert_array_equal(slots[replica, stored], k)
+		sources.append(replica)
+		rmse = np.loadtxt(posterior + 'rmse_train_chain_' + str(temperature) + '.txt', ndmin=1)
+		np.testing.assert_array_equal(rmse, replica*1000 + stored)
+		rows_used = np.loadtxt(posterior + 'rows_used_chain_' + str(temperature) + '.txt', dtype=int)
+		np.testing.assert_array_equal(slots[rows_used // 1000, np.arange(pt.num_samples)], k)
+		np.testing.assert_array_equal(rows_used % 1000, np.arange(pt.num_samples))
+		log, header = pt_bntl.read_posterior(directory + '/acceptlist_' + str(temperature) + '.bin')
+		assert header['temperature'] == temperature
+		np.testing.assert_array_equal(log['iteration'], np.arange(pt.num_samples - 1))
+		np.testing.assert_array_equal(slots[log['likelihood'].astype(int), log['iteration'] + 1], k)
+		accept = np.loadtxt(posterior + 'accept_list_chain_' + str(temperature) + '_accept.txt')
+		assert accept == pytest.approx(np.sum(log['accepted']) * 100 / pt.num_samples, abs=0.01)
+	#each stored row of every replica lands in exactly one temperature file
+	np.testing.assert_array_equal(np.sort(np.array(sources), axis=0), np.tile(np.arange(pt.num_chains)[:, None], (1, stored.size)))
+	assert not [name for name in os.listdir(posterior) if 'replica_' in name]
+	assert not [name for name in os.listdir(directory) if 'replica_' in name]
+
+def test_relabel_with_fixed_labels_is_identity(tmp_path):
+	pt = Relabel(3, 30, 0.2, 2, False)
+	slots = np.tile(np.arange(pt.num_chains)[:, None], (1, pt.num_samples))
+	directory = str(tmp_path)
+	stored = write_replicas(directory, pt, slots)
+	pt.relabel_chains(directory)
+	for k, temperature in enumerate(pt.temperatures):
+		pos_w, header = pt_bntl.read_posterior(directory + '/posterior/pos_w_chain_' + str(temperature) + '.bin')
+		np.testing.assert_array_equal(pos_w, np.column_stack([np.full(stored.size, k), stored]))
+
+@pytest.mark.parametrize('swap_labels', [False, True])
+def test_infinite_ladder(tmp_path, monkeypatch, swap_labels):
+	#the hottest chain at T = inf samples the prior, nothing it swaps or logs may turn into 0*inf
+	monkeypatch.chdir(tmp_path)
+	rng = np.random.default_rng(1)
+	topology = [6, 5, 2]
+	pt = pt_bntl.ParallelTemperingTL(3, 90, 1, [make_data(rng, 60, topology)], [make_data(rng, 30, topology)], make_data(rng, 60, topology), make_data(rng, 30, topology), topology, str(tmp_path / 'res'), np.inf, 2, seed=3, swap_labels=swap_labels)
+	pt.initialize_chains(0.2)
+	pt.run_chains()
+	assert pt.temperatures[-1] == np.inf
+	for task in ('source_0', 'target'):
+		for temperature in pt.temperatures:
+			log, header = pt_bntl.read_posterior(str(tmp_path / 'res' / task / ('acceptlist_' + str(temperature) + '.bin')))
+			assert np.all(np.isfinite(log['likelihood'])) and np.all(np.isfinite(log['log_ratio']))
+
+def test_rows_used_counts_full_passes(tmp_path, monkeypatch):
+	#with swap_labels no state is swapped in, so only the full pass over an accepted state comes on top of the decision
+	monkeypatch.chdir(tmp_path)
+	rng = np.random.default_rng(2)
+	topology = [6, 5, 2]
+	trainsize = 60
+	pt = pt_bntl.ParallelTemperingTL(3, 90, 1, [make_data(rng, trainsize, topology)], [make_data(rng, 30, topology)], make_data(rng, trainsize, topology), make_data(rng, 30, topology), topology, str(tmp_path / 'res'), 5, 4, seed=4, subsample=10, swap_labels=True)
+	pt.initialize_chains(0.2)
+	pt.run_chains()
+	for task in ('source_0', 'target'):
+		for temperature in pt.temperatures:
+			rows_used = np.loadtxt(str(tmp_path / 'res' / task / 'posterior' / ('rows_used_chain_' + str(temperature) + '.txt')), dtype=int)
+			log, header = pt_bntl.read_posterior(str(tmp_path / 'res' / task / ('acceptlist_' + str(temperature) + '.bin')))
+			accepted = log['accepted']
+			assert rows_used[0] == 0 and np.all(rows_used[1:] >= 10)
+			assert np.all(rows_used[1:][accepted] > trainsize) and np.all(rows_used[1:][~accepted] <= trainsize)
+
+@pytest.mark.parametrize('block_proposals', [False, True])
+def test_seed_reproduces_the_run(tmp_path, monkeypatch, block_proposals):
+	monkeypatch.chdir(tmp_path)
+	topology = [6, 5, 2]
+	runs = []
+	for run in range(2):
+		rng = np.random.default_rng(5)
+		directory = str(tmp_path / ('res' + str(run)))
+		pt = pt_bntl.ParallelTemperingTL(3, 60, 1, [make_data(rng, 40, topology)], [make_data(rng, 20, topology)], make_data(rng, 40, topology), make_data(rng, 20, topology), topology, directory, 5, 4, seed=7, block_proposals=block_proposals)
+		pt.initialize_chains(0.2)
+		pt.run_chains()
+		runs.append([pt_bntl.read_posterior(directory + '/target/posterior/pos_w_chain_' + str(temperature) + '.bin')[0] for temperature in pt.temperatures])
+	for first, second in zip(*runs):
+		np.testing.assert_array_equal(first, second)
+
+@pytest.mark.parametrize('langevin, subsample', [(False, None), (True, None), (False, 10)])
+def test_accept_log_holds_the_mh_ratio(tmp_path, monkeypatch, langevin, subsample):
+	#u < 1, so every step the log records a non-negative log ratio for was accepted, and log u < log_ratio for all accepted
+	monkeypatch.chdir(tmp_path)
+	rng = np.random.default_rng(6)
+	topology = [6, 5, 2]
+	pt = pt_bntl.ParallelTemperingTL(3, 300, 1, [make_data(rng, 60, topology)], [make_data(rng, 30, topology)], make_data(rng, 60, topology), make_data(rng, 30, topology), topology, str(tmp_path / 'res'), 5, 10, seed=8, langevin=langevin, subsample=subsample)
+	pt.initialize_chains(0.2)
+	pt.run_chains()
+	for task in ('source_0', 'target'):
+		for temperature in pt.temperatures:
+			log, header = pt_bntl.read_posterior(str(tmp_path / 'res' / task / ('acceptlist_' + str(temperature) + '.bin')))
+			assert np.all(log['accepted'][log['log_ratio'] >= 0])
+			assert np.all(log['log_ratio'][~log['accepted']] < 0)
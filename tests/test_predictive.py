@@ -0,0 +1,62 @@
+
+""" PredictiveSummary in pt_fnn_multi against numpy on the stored samples"""
+
+import numpy as np
+import pytest
+
+import pt_fnn_multi
+
+#(samples, bins): raw storage while samples <= bins, the histogram beyond
+RAW = (80, 100)
+HISTOGRAM = (3000, 100)
+
+def samples(rng, count, rows):
+	#sigmoid outputs, the range the histogram spans
+	return 1/(1 + np.exp(-rng.normal(0, 1.5, (count, rows))))
+
+def summarize(fx, bins):
+	summary = pt_fnn_multi.PredictiveSummary(fx.shape[1], fx.shape[0], bins)
+	for row in fx:
+		summary.update(row)
+	return summary
+
+def check(summary, fx, exact):
+	np.testing.assert_allclose(summary.mean, np.mean(fx, axis=0), rtol=1e-12)
+	np.testing.assert_allclose(summary.variance(), np.var(fx, axis=0), rtol=1e-10)
+	for q in (0.05, 0.5, 0.95):
+		if exact:
+			np.testing.assert_allclose(summary.quantile(q), np.quantile(fx, q, axis=0), rtol=1e-12)
+		else:
+			np.testing.assert_allclose(summary.quantile(q), np.quantile(fx, q, axis=0), atol=2.0/summary.bins)
+
+@pytest.mark.parametrize('count, bins', [RAW, HISTOGRAM])
+def test_summary(count, bins):
+	fx = samples(np.random.default_rng(0), count, 4)
+	summary = summarize(fx, bins)
+	assert (summary.raw is not None) == (count <= bins)
+	if summary.raw is not None:  # never more than the dense array of the same samples
+		assert summary.raw.nbytes <= fx.nbytes
+	check(summary, fx, exact=summary.raw is not None)
+
+@pytest.mark.parametrize('first, second, bins', [(30, 50, 100), (60, 70, 100), (1000, 2000, 100)])
+def test_merge_pools_chains(first, second, bins):
+	fx = samples(np.random.default_rng(1), first + second, 4)
+	merged = summarize(fx[:first], bins).merge(summarize(fx[first:], bins))
+	assert merged.count == first + second
+	#pooled raw samples stay raw up to bins, beyond that both sides go to the histogram
+	assert (merged.raw is not None) == (first + second <= bins)
+	check(merged, fx, exact=merged.raw is not None)
+
+@pytest.mark.parametrize('count, bins', [RAW, HISTOGRAM])
+def test_save_load(tmp_path, count, bins):
+	fx = samples(np.random.default_rng(2), count, 3)
+	summary = summarize(fx, bins)
+	summary.save(str(tmp_path / 'summary.npz'))
+	loaded = pt_fnn_multi.PredictiveSummary.load(str(tmp_path / 'summary.npz'))
+	assert loaded.count == summary.count and loaded.bins == summary.bins
+	assert (loaded.raw is None) == (summary.raw is None)
+	np.testing.assert_array_equal(loaded.mean, summary.mean)
+	np.testing.assert_array_equal(loaded.variance(), summary.variance())
+	for q in (0.05, 0.5, 0.95):
+		np.testing.assert_array_equal(loaded.quantile(q), summary.quantile(q))
+	check(loaded, fx, exact=loaded.raw is not None)
@@ -0,0 +1,81 @@
+
+""" ptReplica MH helpers in pt_bntl"""
+
+import numpy as np
+import pytest
+
+import pt_bntl
+
+TOPOLOGY = [6, 5, 2]
+
+def make_data(rng, rows, topology):
+	x = rng.random((rows, topology[0]))
+	return np.hstack([x, 1/(1 + np.exp(-(x[:, :topology[-1]] - 0.5)))])
+
+def make_replica(traindata, temperature, subsample, epsilon=0.05, train_inputs=None):
+	#the attributes subsampled_mh_test reads, without starting a process
+	replica = pt_bntl.ptReplica.__new__(pt_bntl.ptReplica)
+	replica.topology = TOPOLOGY
+	replica.temperature = temperature
+	replica.backend = pt_bntl.NumpyBackend()
+	replica.traindata = traindata
+	replica.train_inputs = train_inputs
+	replica.subsample = subsample
+	replica.epsilon = epsilon
+	replica.rng = np.random.default_rng(2)
+	replica.order = None
+	return replica
+
+def tempered_difference(replica, fnn, w_proposal, w_current, tau_pro, tau_current):
+	#exact full-data difference of the tempered log-likelihoods
+	proposal = replica.likelihood_func(fnn, replica.traindata, w_proposal, tau_pro)[0]
+	current = replica.likelihood_func(fnn, replica.traindata, w_current, tau_current)[0]
+	return proposal - current
+
+@pytest.mark.parametrize('temperature', [1.0, 3.0])
+def test_full_subsample_is_exact(temperature):
+	rng = np.random.default_rng(0)
+	data = make_data(rng, 50, TOPOLOGY)
+	replica = make_replica(data, temperature, subsample=data.shape[0])
+	fnn = pt_bntl.Network(TOPOLOGY, data, data, 0.1)
+	size = TOPOLOGY[0]*TOPOLOGY[1] + TOPOLOGY[1]*TOPOLOGY[2] + TOPOLOGY[1] + TOPOLOGY[2]
+	w_current = rng.standard_normal(size)
+	w_proposal = w_current + 0.1*rng.standard_normal(size)
+	tau_current, tau_pro = 0.05, 0.07
+	sq_current = replica.row_sq_error(fnn, data, w_current)
+	exact = tempered_difference(replica, fnn, w_proposal, w_current, tau_pro, tau_current)
+	for threshold in (exact/data.shape[0] - 1.0, exact/data.shape[0] + 1.0):
+		accept, difference, rows_used = replica.subsampled_mh_test(fnn, w_proposal, tau_pro, tau_current, sq_current, threshold)
+		assert rows_used == data.shape[0]
+		assert difference == pytest.approx(exact, rel=1e-12, abs=1e-12)
+		assert accept == (exact/data.shape[0] > threshold)
+
+def test_clear_decisions_stop_early():
+	rng = np.random.default_rng(1)
+	data = make_data(rng, 400, TOPOLOGY)
+	replica = make_replica(data, 1.0, subsample=20)
+	fnn = pt_bntl.Network(TOPOLOGY, data, data, 0.1)
+	size = TOPOLOGY[0]*TOPOLOGY[1] + TOPOLOGY[1]*TOPOLOGY[2] + TOPOLOGY[1] + TOPOLOGY[2]
+	w_current = rng.standard_normal(size)
+	w_proposal = w_current + 0.01*rng.standard_normal(size)
+	sq_current = replica.row_sq_error(fnn, data, w_current)
+	mean = tempered_difference(replica, fnn, w_proposal, w_current, 0.05, 0.05) / data.shape[0]
+	#thresholds far from the mean difference are decided on a small subset, and decided correctly
+	for threshold, expected in ((mean - 10.0, True), (mean + 10.0, False)):
+		accept, difference, rows_used = replica.subsampled_mh_test(fnn, w_proposal, 0.05, 0.05, sq_current, threshold)
+		assert accept == expected
+		assert rows_used < data.shape[0]
+
+@pytest.mark.parametrize('num_blocks', [None, 4])
+def test_step_stream_across_blocks(num_blocks):
+	#a small block size refills several times, each draw still comes from the right distribution and range
+	steps = pt_bntl.StepStream(np.random.default_rng(5), 0.2, num_blocks, block_size=7)
+	draws = [steps.draw() for i in range(3000)]
+	eta_steps, uniforms, blocks = (np.array(column) for column in zip(*draws))
+	assert eta_steps.std() == pytest.approx(0.2, rel=0.1) and abs(eta_steps.mean()) < 0.02
+	assert np.all((uniforms >= 0) & (uniforms < 1)) and uniforms.mean() == pytest.approx(0.5, abs=0.03)
+	if num_blocks is None:
+		assert all(block is None for block in blocks)
+	else:
+		assert set(blocks) == set(range(num_blocks))
+	assert len(set(eta_steps)) == eta_steps.size  # no block handed out twice